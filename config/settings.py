@@ -17,24 +17,28 @@ class Settings(BaseSettings):
     vllm_server_url: str = Field(default="http://192.168.8.6:8000", env="VLLM_SERVER_URL")
     model_name: str = Field(default="qwenOmni7", env="MODEL_NAME")
     api_key: str = Field(default="abc123", env="API_KEY")
+    max_concurrent_llm_requests: int = Field(default=100, env="MAX_CONCURRENT_LLM_REQUESTS")  # 同时进行的LLM请求上限
     
     # 多LLM后端配置 (新增)
     llm_backends: Optional[List[Dict[str, Any]]] = Field(default=None, env="LLM_BACKENDS")
     
     # 负载均衡配置 (新增)
     load_balance_enabled: Optional[bool] = Field(default=None, env="LOAD_BALANCE_ENABLED")  # 显式控制开关
-    load_balance_strategy: str = Field(default="round_robin", env="LOAD_BALANCE_STRATEGY")
+    load_balance_strategy: str = Field(default="consistent_hash_failover", env="LOAD_BALANCE_STRATEGY")
     health_check_interval: float = Field(default=30.0, env="HEALTH_CHECK_INTERVAL")
+    health_check_concurrency: int = Field(default=16, env="HEALTH_CHECK_CONCURRENCY")  # 同时进行的健康检查数上限
     max_retries: int = Field(default=2, env="MAX_RETRIES")
     failure_threshold: int = Field(default=3, env="FAILURE_THRESHOLD")
+    hash_ring_vnodes_per_weight: int = Field(default=40, env="HASH_RING_VNODES_PER_WEIGHT")  # 一致性哈希每单位权重的虚拟节点数
     
     # 文件上传配置
     max_upload_size: int = Field(default=16 * 1024 * 1024, env="MAX_UPLOAD_SIZE")  # 16MB
     allowed_extensions: List[str] = Field(default=["wav", "opus", "mp3", "flac", "m4a", "aac", "ogg"], env="ALLOWED_EXTENSIONS")
+    temp_dir: Optional[str] = Field(default=None, env="TEMP_DIR")  # 上传和转换文件的临时目录，默认使用系统临时目录
     
     # 音频转换性能配置 (新增)
-    max_concurrent_audio_conversions: int = Field(default=10, env="MAX_CONCURRENT_AUDIO_CONVERSIONS")
-    audio_converter_workers: int = Field(default=5, env="AUDIO_CONVERTER_WORKERS")
+    max_concurrent_audio_conversions: int = Field(default_factory=lambda: 2 * (os.process_cpu_count() or 5), env="MAX_CONCURRENT_AUDIO_CONVERSIONS")  # 默认CPU核心数 * 2，避免FFmpeg进程过多争抢CPU
+    audio_converter_workers: int = Field(default=5, env="AUDIO_CONVERTER_WORKERS")  # 已不再使用：转换以异步子进程执行，仅为兼容旧配置保留
     
     # 鉴权配置
     auth_enabled: bool = Field(default=True, env="AUTH_ENABLED")
@@ -44,7 +48,15 @@ class Settings(BaseSettings):
     # Redis缓存配置
     redis_enabled: bool = Field(default=False, env="REDIS_ENABLED")
     redis_url: str = Field(default="redis://localhost:6379/0", env="REDIS_URL")
-    api_key_cache_ttl: int = Field(default=300, env="API_KEY_CACHE_TTL")  # 5分钟缓存
+    redis_connect_timeout: float = Field(default=0.2, env="REDIS_CONNECT_TIMEOUT")  # 秒
+    redis_socket_timeout: float = Field(default=0.1, env="REDIS_SOCKET_TIMEOUT")  # 秒，超时即回源数据库
+    api_key_cache_ttl: int = Field(default=300, env="API_KEY_CACHE_TTL")  # 5分钟缓存（命中时续期）
+    api_key_cache_max_age: int = Field(default=300, env="API_KEY_CACHE_MAX_AGE")  # 续期后的最长缓存时间
+    api_key_local_cache_size: int = Field(default=1024, env="API_KEY_LOCAL_CACHE_SIZE")  # 进程内缓存条目数
+    api_key_local_cache_ttl: float = Field(default=30.0, env="API_KEY_LOCAL_CACHE_TTL")  # 进程内缓存秒数
+    api_key_negative_ttl: int = Field(default=5, env="API_KEY_NEGATIVE_TTL")  # 无效密钥缓存秒数
+    auth_failure_limit: int = Field(default=20, env="AUTH_FAILURE_LIMIT")  # 每个IP每分钟允许的鉴权失败次数
+    trusted_proxies: List[str] = Field(default=[], env="TRUSTED_PROXIES")  # 受信任的反向代理地址或网段，来自这些地址的请求从X-Forwarded-For获取客户端IP
     
     # 数据库配置
     database_path: str = Field(default="data/api_keys.db", env="DATABASE_PATH")
@@ -75,7 +87,7 @@ class Settings(BaseSettings):
         """验证负载均衡策略"""
         valid_strategies = [
             "round_robin", "weighted_round_robin", "least_connections",
-            "random", "consistent_hash", "response_time"
+            "random", "consistent_hash", "consistent_hash_failover", "response_time"
         ]
         if v not in valid_strategies:
             raise ValueError(f"负载均衡策略必须是以下之一: {valid_strategies}")
@@ -7,6 +7,7 @@ Lingualink Server API密钥管理工具 v2.0
 
 import requests
 import argparse
+import asyncio
 import json
 import sys
 from datetime import datetime, timedelta
@@ -162,7 +163,7 @@ class LocalKeyManager:
             return False
         
         try:
-            return self.auth_service.revoke_api_key(api_key)
+            return asyncio.run(self.auth_service.revoke_api_key(api_key))
         except Exception as e:
             print(f"❌ 撤销密钥失败: {e}")
             return False
@@ -184,7 +185,7 @@ class LocalKeyManager:
             return False
         
         try:
-            return self.auth_service.set_admin_status(api_key, is_admin)
+            return asyncio.run(self.auth_service.set_admin_status(api_key, is_admin))
         except Exception as e:
             print(f"❌ 设置管理员状态失败: {e}")
             return False
@@ -338,7 +338,7 @@ def main():
     set_strategy_parser.add_argument("--strategy", required=True, 
                                    choices=["round_robin", "weighted_round_robin", 
                                           "least_connections", "random", 
-                                          "consistent_hash", "response_time"],
+                                          "consistent_hash", "consistent_hash_failover", "response_time"],
                                    help="负载均衡策略")
     set_strategy_parser.add_argument("--health-check-interval", type=float, help="健康检查间隔")
     set_strategy_parser.add_argument("--max-retries", type=int, help="最大重试次数")
@@ -1,5 +1,4 @@
 from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Depends
-from fastapi.concurrency import run_in_threadpool
 from typing import Optional, List
 import logging
 
@@ -41,8 +40,8 @@ async def translate_audio(
     original_file_path: Optional[str] = None
     
     try:
-        logger.info(f"Received translation request: filename={audio_file.filename}, "
-                   f"user_prompt={user_prompt}, target_languages={target_languages}")
+        logger.info("Received translation request: filename=%s, user_prompt=%s, target_languages=%s",
+                    audio_file.filename, user_prompt, target_languages)
         
         # 处理和转换音频文件
         wav_file_path, original_file_path = await audio_processor.process_and_convert_audio(audio_file)
@@ -59,17 +58,16 @@ async def translate_audio(
         
         # 生成系统提示词
         system_prompt = llm_service.generate_system_prompt(final_target_languages)
-        logger.info(f"Using system prompt with languages: {final_target_languages or settings.default_target_languages}")
+        logger.info("Using system prompt with languages: %s", final_target_languages or settings.default_target_languages)
         
-        # 在线程池中处理音频（使用转换后的WAV文件）
-        result = await run_in_threadpool(
-            llm_service.process_audio,
+        # 异步处理音频（使用转换后的WAV文件）
+        result = await llm_service.process_audio(
             wav_file_path,
             system_prompt,
             user_prompt
         )
         
-        logger.info(f"Processing completed with status: {result.get('status')}")
+        logger.info("Processing completed with status: %s", result.get('status'))
         return result
 
     except ValueError as ve:
@@ -105,7 +103,7 @@ async def translate_audio(
     finally:
         # 清理临时文件
         if wav_file_path and original_file_path:
-            audio_processor.cleanup_audio_files(wav_file_path, original_file_path)
+            await audio_processor.cleanup_audio_files_async(wav_file_path, original_file_path)
         
         # 关闭上传文件
         if audio_file:
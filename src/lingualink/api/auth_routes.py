@@ -122,7 +122,7 @@ async def revoke_api_key(
                 }
             )
         
-        success = auth_service.revoke_api_key(api_key_to_revoke)
+        success = await auth_service.revoke_api_key(api_key_to_revoke)
         
         if success:
             logger.info(f"API key revoked by {current_api_key[:8]}...")
@@ -207,7 +207,7 @@ async def cleanup_expired_keys(
 ):
     """清理已过期的API密钥"""
     try:
-        count = auth_service.cleanup_expired_keys()
+        count = await auth_service.cleanup_expired_keys()
         
         logger.info(f"Expired keys cleanup triggered by {current_api_key[:8]}, cleaned: {count}")
         
@@ -20,7 +20,7 @@ async def get_cache_stats(
 ) -> Dict[str, Any]:
     """获取缓存统计信息"""
     try:
-        stats = redis_cache.get_cache_stats()
+        stats = await redis_cache.get_cache_stats()
         
         return {
             "status": "success",
@@ -45,7 +45,7 @@ async def get_cache_stats(
 async def check_cache_health() -> Dict[str, Any]:
     """检查缓存健康状态"""
     try:
-        is_healthy = redis_cache.health_check()
+        is_healthy = await redis_cache.health_check()
         
         return {
             "status": "success",
@@ -77,7 +77,7 @@ async def clear_cache(
 ) -> Dict[str, Any]:
     """清空所有缓存"""
     try:
-        success = redis_cache.clear_all_cache()
+        success = await redis_cache.clear_all_cache()
         
         if success:
             logger.info(f"Cache cleared by admin: {current_api_key[:8]}...")
@@ -115,7 +115,7 @@ async def invalidate_api_key_cache(
     try:
         # 注意：这里需要完整的API密钥，而不是前缀
         # 在实际使用中，管理员应该提供完整的API密钥
-        success = redis_cache.invalidate_api_key(api_key_prefix)
+        success = await redis_cache.invalidate_api_key(api_key_prefix)
         
         if success:
             logger.info(f"Cache invalidated for key {api_key_prefix[:8]}... by admin: {current_api_key[:8]}...")
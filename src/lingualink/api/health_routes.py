@@ -109,7 +109,8 @@ async def get_performance_stats():
                 **audio_stats,
                 "config": {
                     "max_concurrent_conversions": settings.max_concurrent_audio_conversions,
-                    "max_converter_workers": settings.audio_converter_workers,
+                    # 转换以异步FFmpeg子进程执行，同时运行的子进程数即并发转换上限
+                    "max_converter_workers": settings.max_concurrent_audio_conversions,
                     "max_upload_size_mb": settings.max_upload_size // (1024 * 1024),
                     "supported_formats": list(settings.allowed_extensions)
                 }
@@ -152,13 +153,13 @@ async def get_concurrent_status():
                 "queue_available_slots": max_concurrent - active_conversions
             },
             "worker_pool": {
-                "max_workers": settings.audio_converter_workers,
-                "estimated_load": "Unknown"  # 难以从ThreadPoolExecutor获取精确信息
+                "max_workers": max_concurrent,
+                "estimated_load": f"{utilization_percent:.1f}%"
             },
             "performance_metrics": {
                 "total_requests_processed": audio_processor.request_count,
                 "average_processing_time_seconds": round(
-                    audio_processor.total_processing_time / max(audio_processor.request_count, 1), 2
+                    audio_processor.get_average_processing_time(), 2
                 )
             }
         }
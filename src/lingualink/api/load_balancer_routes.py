@@ -297,7 +297,7 @@ async def update_strategy(request: StrategyUpdateRequest, api_key: str = Depends
             service.load_balancer.failure_threshold = request.failure_threshold
         
         # 如果策略变为一致性哈希，重建哈希环
-        if new_strategy == LoadBalanceStrategy.CONSISTENT_HASH:
+        if new_strategy in (LoadBalanceStrategy.CONSISTENT_HASH, LoadBalanceStrategy.CONSISTENT_HASH_FAILOVER):
             service.load_balancer._build_hash_ring()
         
         return {
@@ -1,8 +1,10 @@
 from .auth_service import AuthService
-from .dependencies import get_current_api_key, verify_api_key
+from .dependencies import AuthContext, get_auth_context, get_current_api_key, verify_api_key
 
 __all__ = [
     "AuthService",
+    "AuthContext",
+    "get_auth_context",
     "get_current_api_key", 
     "verify_api_key"
 ] 
\ No newline at end of file
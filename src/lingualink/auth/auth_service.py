@@ -1,20 +1,57 @@
-import hashlib
+import asyncio
 import secrets
+import threading
+import time
+from collections import Counter
 from typing import List, Optional, Dict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from config.settings import settings
 from ..models.database import APIKey, get_db_session
 from .redis_cache import redis_cache
+from .local_cache import LocalTTLCache
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class AuthRateLimitedError(Exception):
+    """同一IP鉴权失败次数过多，本次无效密钥请求被限流"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many failed authentication attempts, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
 class AuthService:
     """基于数据库的鉴权服务"""
     
+    # 缓存命中时的使用统计批量写回阈值
+    USAGE_FLUSH_BATCH_SIZE = 100
+    USAGE_FLUSH_INTERVAL = 5.0  # 秒
+    
+    # 缓存未命中时等待其他请求回填缓存的轮询参数
+    REFRESH_WAIT_INTERVAL = 0.05  # 秒
+    REFRESH_WAIT_ATTEMPTS = 5
+    
     def __init__(self):
         """初始化鉴权服务"""
+        # 待写回的使用次数，显式加锁以保证在无GIL（free-threaded）构建下也是线程安全的
+        self._usage_lock = threading.Lock()
+        self._pending_usage: Counter = Counter()
+        self._pending_usage_total = 0
+        self._last_usage_flush = time.monotonic()
+        # 进行中的后台写回任务（保留引用，避免任务被回收，关闭时等待完成）
+        self._flush_tasks: set = set()
+        # 进程内一级缓存（键为密钥的带密钥摘要），命中时无需访问Redis
+        self._local_cache: LocalTTLCache[bool] = LocalTTLCache(
+            maxsize=settings.api_key_local_cache_size,
+            ttl=settings.api_key_local_cache_ttl
+        )
+        # 进程内负缓存：近期验证为无效的密钥直接拒绝，不访问Redis和数据库
+        self._local_negative_cache: LocalTTLCache[bool] = LocalTTLCache(
+            maxsize=settings.api_key_local_cache_size,
+            ttl=settings.api_key_negative_ttl
+        )
         logger.info("Auth service initialized with database backend")
     
     def generate_api_key(self, name: Optional[str] = None, expires_in_days: Optional[int] = None, 
@@ -61,33 +98,95 @@ class AuthService:
         finally:
             session.close()
     
-    def verify_api_key(self, api_key: str) -> tuple[bool, bool]:
+    async def verify_api_key(self, api_key: str, client_ip: Optional[str] = None) -> tuple[bool, bool]:
         """
         验证API密钥（支持Redis缓存）
         
         Args:
             api_key: API密钥
+            client_ip: 客户端IP，用于限制鉴权失败频率
             
         Returns:
             tuple[bool, bool]: (is_valid, is_admin)
+            
+        Raises:
+            AuthRateLimitedError: 密钥无效且该IP鉴权失败次数超过限制
         """
         if not settings.auth_enabled:
             return True, False
         
-        # 首先尝试从Redis缓存获取
-        cached_result = redis_cache.get_api_key_auth(api_key)
+        # 首先查询进程内缓存
+        key_hash = redis_cache.hash_api_key(api_key)
+        local_is_admin = self._local_cache.get(key_hash)
+        if local_is_admin is not None:
+            self._async_update_usage_stats(api_key)
+            return True, local_is_admin
+        if self._local_negative_cache.get(key_hash) is not None:
+            return False, False
+        
+        # 其次尝试从Redis缓存获取（包括无效密钥的负缓存）
+        cached_result = await redis_cache.get_api_key_auth(api_key)
         if cached_result is not None:
-            is_valid, is_admin = cached_result
-            if is_valid:
-                # 异步更新使用统计（不影响响应时间）
-                self._async_update_usage_stats(api_key)
-                logger.debug(f"API key verified from cache: {api_key[:8]}...")
-                return True, is_admin
+            return self._accept_cached_result(api_key, key_hash, cached_result)
+        
+        # 缓存未命中：只让一个请求回源数据库，其余请求等待其回填缓存
+        lock_acquired = await redis_cache.acquire_refresh_lock(api_key)
+        if not lock_acquired:
+            for _ in range(self.REFRESH_WAIT_ATTEMPTS):
+                await asyncio.sleep(self.REFRESH_WAIT_INTERVAL)
+                cached_result = await redis_cache.get_api_key_auth(api_key)
+                if cached_result is not None:
+                    return self._accept_cached_result(api_key, key_hash, cached_result)
+        
+        try:
+            is_valid, is_admin, expires_at = self._verify_api_key_from_db(api_key)
+        except Exception as e:
+            logger.error(f"Error verifying API key: {e}")
+            if lock_acquired:
+                await redis_cache.release_refresh_lock(api_key)
+            return False, False
         
-        # 缓存未命中，查询数据库
-        return self._verify_api_key_from_db(api_key)
+        # 缓存验证结果，回填锁随写入一起释放
+        if is_valid:
+            self._local_cache.set(key_hash, is_admin)
+            await redis_cache.set_api_key_auth(api_key, True, is_admin, release_lock=lock_acquired,
+                                               expires_at=expires_at)
+        else:
+            await self._cache_invalid_result(api_key, key_hash, is_admin, client_ip, lock_acquired)
+        
+        return is_valid, is_admin
+    
+    def _accept_cached_result(self, api_key: str, key_hash: str,
+                              cached_result: tuple[bool, bool]) -> tuple[bool, bool]:
+        """处理Redis缓存命中的验证结果"""
+        is_valid, is_admin = cached_result
+        if is_valid:
+            # 异步更新使用统计（不影响响应时间）
+            self._async_update_usage_stats(api_key)
+            self._local_cache.set(key_hash, is_admin)
+            logger.debug("API key verified from cache: %s...", api_key[:8])
+        else:
+            self._local_negative_cache.set(key_hash, True)
+        return is_valid, is_admin
     
-    def _verify_api_key_from_db(self, api_key: str) -> tuple[bool, bool]:
+    async def _cache_invalid_result(self, api_key: str, key_hash: str, is_admin: bool,
+                                    client_ip: Optional[str], lock_acquired: bool) -> None:
+        """
+        记录鉴权失败并负缓存无效结果；同一IP失败次数超过阈值后不再写入缓存，
+        避免暴力破解请求把无效密钥写满Redis（进程内负缓存有容量上限，始终写入），并以限流错误拒绝。
+        限流只针对数据库确认无效的密钥，同一IP（如共享NAT）上的有效密钥不受影响
+        """
+        self._local_negative_cache.set(key_hash, True)
+        if client_ip:
+            failures = await redis_cache.record_auth_failure(client_ip)
+            if failures > settings.auth_failure_limit:
+                if lock_acquired:
+                    await redis_cache.release_refresh_lock(api_key)
+                logger.warning(f"Too many failed auth attempts from {client_ip}")
+                raise AuthRateLimitedError(redis_cache.AUTH_FAILURE_WINDOW)
+        await redis_cache.set_api_key_auth(api_key, False, is_admin, release_lock=lock_acquired)
+    
+    def _verify_api_key_from_db(self, api_key: str) -> tuple[bool, bool, Optional[float]]:
         """
         从数据库验证API密钥
         
@@ -95,7 +194,8 @@ class AuthService:
             api_key: API密钥
             
         Returns:
-            tuple[bool, bool]: (is_valid, is_admin)
+            tuple[bool, bool, Optional[float]]: (is_valid, is_admin, expires_at)，
+            expires_at为密钥过期的Unix时间戳，None表示永不过期
         """
         session = get_db_session()
         try:
@@ -103,7 +203,7 @@ class AuthService:
             
             if not key_record:
                 logger.warning(f"Invalid API key attempted: {api_key[:8]}...")
-                return False, False  # valid, is_admin
+                return False, False, None  # valid, is_admin, expires_at
             
             is_admin = key_record.is_admin
             
@@ -112,46 +212,115 @@ class AuthService:
                     logger.warning(f"Expired API key attempted: {api_key[:8]}...")
                 else:
                     logger.warning(f"Inactive API key attempted: {api_key[:8]}...")
-                return False, is_admin
+                return False, is_admin, None
             
             # 更新使用次数和最后使用时间
             key_record.usage_count += 1
             key_record.last_used_at = datetime.utcnow()
             session.commit()
             
-            # 缓存验证结果
-            redis_cache.set_api_key_auth(api_key, True, is_admin)
-            
-            logger.debug(f"API key verified from DB: {key_record.name}, usage: {key_record.usage_count}")
-            return True, is_admin
+            logger.debug("API key verified from DB: %s, usage: %s", key_record.name, key_record.usage_count)
+            # expires_at 以 naive UTC 存储
+            expires_at = None
+            if key_record.expires_at is not None:
+                expires_at = key_record.expires_at.replace(tzinfo=timezone.utc).timestamp()
+            return True, is_admin, expires_at
             
-        except Exception as e:
+        except Exception:
             session.rollback()
-            logger.error(f"Error verifying API key: {e}")
-            return False, False
+            raise
         finally:
             session.close()
     
     def _async_update_usage_stats(self, api_key: str):
         """
-        异步更新API密钥使用统计（用于缓存命中的情况）
+        记录API密钥使用统计（用于缓存命中的情况），累积后批量写回数据库
         
         Args:
             api_key: API密钥
         """
-        # 这里可以用异步队列来批量更新，暂时用同步方式
+        with self._usage_lock:
+            self._pending_usage[api_key] += 1
+            self._pending_usage_total += 1
+            should_flush = (
+                self._pending_usage_total >= self.USAGE_FLUSH_BATCH_SIZE or
+                time.monotonic() - self._last_usage_flush >= self.USAGE_FLUSH_INTERVAL
+            )
+        
+        if should_flush:
+            self._schedule_usage_flush()
+    
+    def _schedule_usage_flush(self) -> None:
+        """在线程中写回使用统计，不阻塞事件循环；没有运行中的事件循环时直接写回"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_usage_stats()
+            return
+        
+        task = loop.create_task(asyncio.to_thread(self.flush_usage_stats))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    async def close(self) -> None:
+        """等待进行中的写回完成，并写回剩余的使用统计（应用关闭时调用）"""
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        flushed = await asyncio.to_thread(self.flush_usage_stats)
+        if flushed:
+            logger.info(f"Flushed {flushed} pending API key usage counts on shutdown")
+    
+    def flush_usage_stats(self) -> int:
+        """
+        将累积的使用统计写回数据库
+        
+        Returns:
+            int: 写回的使用次数
+        """
+        with self._usage_lock:
+            pending = self._pending_usage
+            self._pending_usage = Counter()
+            self._pending_usage_total = 0
+            self._last_usage_flush = time.monotonic()
+        
+        if not pending:
+            return 0
+        
+        session = get_db_session()
         try:
-            session = get_db_session()
-            key_record = session.query(APIKey).filter(APIKey.api_key == api_key).first()
-            if key_record:
-                key_record.usage_count += 1
-                key_record.last_used_at = datetime.utcnow()
-                session.commit()
-            session.close()
+            now = datetime.utcnow()
+            for api_key, count in pending.items():
+                session.query(APIKey).filter(APIKey.api_key == api_key).update(
+                    {
+                        APIKey.usage_count: APIKey.usage_count + count,
+                        APIKey.last_used_at: now
+                    },
+                    synchronize_session=False
+                )
+            session.commit()
+            return sum(pending.values())
         except Exception as e:
+            session.rollback()
             logger.error(f"Error updating usage stats: {e}")
+            return 0
+        finally:
+            session.close()
     
-    def revoke_api_key(self, api_key: str) -> bool:
+    def evict_local_cache(self, key_hash: Optional[str] = None) -> None:
+        """
+        使进程内缓存失效
+        
+        Args:
+            key_hash: 密钥的带密钥摘要，为None时清空全部
+        """
+        if key_hash is None:
+            self._local_cache.clear()
+            self._local_negative_cache.clear()
+        else:
+            self._local_cache.pop(key_hash)
+            self._local_negative_cache.pop(key_hash)
+    
+    async def revoke_api_key(self, api_key: str) -> bool:
         """
         撤销API密钥（设置为非活跃状态）
         
@@ -171,8 +340,9 @@ class AuthService:
             key_record.is_active = False
             session.commit()
             
-            # 立即清除缓存
-            redis_cache.invalidate_api_key(api_key)
+            # 立即清除缓存（Redis失效通知会同步清除其他worker的进程内缓存）
+            self._local_cache.pop(redis_cache.hash_api_key(api_key))
+            await redis_cache.invalidate_api_key(api_key)
             
             logger.info(f"API key revoked: {key_record.name}")
             return True
@@ -264,7 +434,7 @@ class AuthService:
         finally:
             session.close()
     
-    def set_admin_status(self, api_key: str, is_admin: bool) -> bool:
+    async def set_admin_status(self, api_key: str, is_admin: bool) -> bool:
         """
         设置密钥的管理员状态
         
@@ -286,6 +456,10 @@ class AuthService:
             key_record.is_admin = is_admin
             session.commit()
             
+            # 缓存中保存了管理员标记，修改后立即清除（Redis失效通知会同步清除其他worker的进程内缓存）
+            self._local_cache.pop(redis_cache.hash_api_key(api_key))
+            await redis_cache.invalidate_api_key(api_key)
+            
             logger.info(f"Admin status for API key {key_record.name} set to {is_admin}")
             return True
             
@@ -296,7 +470,7 @@ class AuthService:
         finally:
             session.close()
     
-    def cleanup_expired_keys(self) -> int:
+    async def cleanup_expired_keys(self) -> int:
         """
         清理已过期的密钥（设置为非活跃状态）
         
@@ -311,17 +485,22 @@ class AuthService:
                 APIKey.is_active == True
             ).all()
             
-            count = 0
+            deactivated = []
             for key in expired_keys:
                 key.is_active = False
-                count += 1
+                deactivated.append(key.api_key)
             
             session.commit()
             
-            if count > 0:
-                logger.info(f"Cleaned up {count} expired API keys")
+            # 逐个清除被停用密钥的缓存（Redis失效通知会同步清除其他worker的进程内缓存）
+            for api_key in deactivated:
+                self._local_cache.pop(redis_cache.hash_api_key(api_key))
+                await redis_cache.invalidate_api_key(api_key)
+            
+            if deactivated:
+                logger.info(f"Cleaned up {len(deactivated)} expired API keys")
             
-            return count
+            return len(deactivated)
             
         except Exception as e:
             session.rollback()
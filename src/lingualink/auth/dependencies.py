@@ -1,10 +1,11 @@
-from fastapi import HTTPException, Depends, status
+import ipaddress
+from fastapi import HTTPException, Depends, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.security.api_key import APIKeyHeader
+from dataclasses import dataclass
 from typing import Optional
-from .auth_service import auth_service
+from .auth_service import AuthRateLimitedError, auth_service
 from config.settings import settings
-from ..models.database import APIKey, get_db_session
 
 # API Key 认证方式
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
@@ -13,7 +14,58 @@ api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 security = HTTPBearer(auto_error=False)
 
 
-async def verify_api_key(api_key: Optional[str] = Depends(api_key_header)) -> str:
+# 受信任的反向代理网段，启动时解析一次
+_TRUSTED_PROXIES = tuple(ipaddress.ip_network(proxy, strict=False) for proxy in settings.trusted_proxies)
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    """判断地址是否属于受信任的反向代理"""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in _TRUSTED_PROXIES)
+
+
+def _client_ip(request: Request) -> Optional[str]:
+    """
+    获取客户端IP；直连地址是受信任的代理时，取X-Forwarded-For中最右侧的非代理地址
+    （左侧部分可由客户端伪造，只有受信任代理追加的地址可信）
+    """
+    if not request.client:
+        return None
+    
+    client_ip = request.client.host
+    if not _TRUSTED_PROXIES or not _is_trusted_proxy(client_ip):
+        return client_ip
+    
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if not forwarded_for:
+        return client_ip
+    
+    for hop in reversed(forwarded_for.split(",")):
+        hop = hop.strip()
+        if hop and not _is_trusted_proxy(hop):
+            return hop
+    return client_ip
+
+
+async def _verify_request_api_key(request: Request, api_key: str) -> tuple[bool, bool]:
+    """验证请求携带的API密钥，同一IP鉴权失败过多时返回429"""
+    try:
+        return await auth_service.verify_api_key(api_key, _client_ip(request))
+    except AuthRateLimitedError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "status": "error",
+                "message": "Too many failed authentication attempts. Please retry later."
+            },
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+async def verify_api_key(request: Request, api_key: Optional[str] = Depends(api_key_header)) -> str:
     """验证API密钥依赖项"""
     if not settings.auth_enabled:
         return "auth_disabled"
@@ -27,7 +79,7 @@ async def verify_api_key(api_key: Optional[str] = Depends(api_key_header)) -> st
             }
         )
     
-    is_valid, _ = auth_service.verify_api_key(api_key) # Ignore is_admin for basic verification
+    is_valid, _ = await _verify_request_api_key(request, api_key) # Ignore is_admin for basic verification
     if not is_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -40,19 +92,27 @@ async def verify_api_key(api_key: Optional[str] = Depends(api_key_header)) -> st
     return api_key
 
 
-async def get_current_api_key(
+@dataclass
+class AuthContext:
+    """当前请求的鉴权结果"""
+    api_key: str
+    is_admin: bool = False
+
+
+async def get_auth_context(
+    request: Request,
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
     api_key: Optional[str] = Depends(api_key_header)
-) -> str:
-    """获取当前API密钥（支持多种认证方式）"""
+) -> AuthContext:
+    """验证当前请求的API密钥（支持多种认证方式），同一请求内只验证一次"""
     if not settings.auth_enabled:
-        return "auth_disabled"
+        return AuthContext(api_key="auth_disabled")
     
     # 优先使用 X-API-Key header
     if api_key:
-        is_valid, _ = auth_service.verify_api_key(api_key)
+        is_valid, is_admin = await _verify_request_api_key(request, api_key)
         if is_valid:
-            return api_key
+            return AuthContext(api_key=api_key, is_admin=is_admin)
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -65,9 +125,9 @@ async def get_current_api_key(
     # 其次使用 Bearer token
     if credentials:
         token = credentials.credentials
-        is_valid, _ = auth_service.verify_api_key(token)
+        is_valid, is_admin = await _verify_request_api_key(request, token)
         if is_valid:
-            return token
+            return AuthContext(api_key=token, is_admin=is_admin)
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -84,24 +144,24 @@ async def get_current_api_key(
             "status": "error",
             "message": "Authentication required. Please provide API key via X-API-Key header or Authorization: Bearer <token>."
         }
-    ) 
+    )
+
+
+async def get_current_api_key(auth: AuthContext = Depends(get_auth_context)) -> str:
+    """获取当前API密钥（支持多种认证方式）"""
+    return auth.api_key
 
 
-async def get_current_admin_api_key(
-    api_key: str = Depends(get_current_api_key) # Reuse the basic key getter
-) -> str:
+async def get_current_admin_api_key(auth: AuthContext = Depends(get_auth_context)) -> str:
     """
     获取当前API密钥，并验证其是否为管理员密钥。
-    依赖于 get_current_api_key 先成功获取并验证密钥的基本有效性。
+    复用 get_auth_context 的验证结果，不再重复查询缓存或数据库。
     """
-    if api_key == "auth_disabled": # 处理认证禁用的情况
-        return api_key
-
-    # 直接使用auth_service验证管理员权限（包含缓存支持）
-    is_valid, is_admin = auth_service.verify_api_key(api_key)
+    if auth.api_key == "auth_disabled": # 处理认证禁用的情况
+        return auth.api_key
     
-    if is_valid and is_admin:
-        return api_key
+    if auth.is_admin:
+        return auth.api_key
     else:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -109,4 +169,4 @@ async def get_current_admin_api_key(
                 "status": "error",
                 "message": "Admin privileges required for this operation."
             }
-        ) 
\ No newline at end of file
+        )
@@ -1,8 +1,9 @@
-import redis
-import json
+import redis.asyncio as redis
+import asyncio
+import hashlib
 import logging
-from typing import Optional, Tuple, Dict, Any
-from datetime import datetime, timedelta
+import time
+from typing import Optional, Tuple, Dict, Any, Callable
 from config.settings import settings
 
 logger = logging.getLogger(__name__)
@@ -11,42 +12,180 @@ logger = logging.getLogger(__name__)
 class RedisCache:
     """Redis缓存管理器"""
     
+    # 缓存回填锁的过期时间（秒），防止持锁请求异常退出后锁永不释放
+    REFRESH_LOCK_TTL = 5
+    
+    # 遍历缓存键时使用的模式和每批数量（SCAN 不会像 KEYS 一样阻塞Redis）
+    CACHE_KEY_PATTERN = "api_key_auth:*"
+    SCAN_BATCH_SIZE = 500
+    
+    # 密钥失效通知频道，用于同步各worker的进程内缓存；INVALIDATE_ALL 表示全部失效
+    INVALIDATION_CHANNEL = "api_key_invalidate"
+    INVALIDATE_ALL = "*"
+    
+    # 鉴权失败计数的统计窗口（秒）
+    AUTH_FAILURE_WINDOW = 60
+    
+    # 熔断参数：窗口内Redis调用失败达到阈值后，在冷却期内跳过Redis，直接回源数据库
+    BREAKER_FAILURE_THRESHOLD = 5
+    BREAKER_FAILURE_WINDOW = 10.0  # 秒
+    BREAKER_COOLDOWN = 30.0  # 秒
+    
+    # 缓存内容为 "<is_admin>:<cached_at>:<expires_at>"（expires_at为密钥过期的Unix时间戳，0表示永不过期），
+    # 只有有效密钥才会写入；"-" 为无效密钥的负缓存
+    NEGATIVE_PAYLOAD = "-"
+    
+    # 读取缓存并在同一次往返中续期（滑动过期），续期不会超过密钥本身的过期时间；
+    # 负缓存保持原有的短TTL，不续期
+    GET_AND_TOUCH_SCRIPT = """
+local v = redis.call('GET', KEYS[1])
+if v and v ~= ARGV[2] then
+    local ttl = tonumber(ARGV[1])
+    local expires_at = tonumber(string.match(v, '^%d+:%d+:(%d+)$'))
+    if expires_at and expires_at > 0 then
+        ttl = math.min(ttl, expires_at - tonumber(ARGV[3]))
+    end
+    if ttl > 0 then
+        redis.call('EXPIRE', KEYS[1], ttl)
+    end
+end
+return v
+"""
+    
     def __init__(self):
-        """初始化Redis连接"""
+        """初始化Redis客户端（连接池惰性建立，连接测试在 initialize 中进行）"""
         self._client = None
+        self._pubsub_client = None
         self._enabled = settings.redis_enabled
+        self._failure_count = 0
+        self._failure_window_start = 0.0
+        self._breaker_open_until = 0.0
+        # 缓存键使用带密钥的哈希，既避免前缀碰撞，也不会把原始密钥写入Redis
+        self._cache_secret = hashlib.sha256(settings.secret_key.encode()).digest()
         
         if self._enabled:
             try:
                 self._client = redis.from_url(
                     settings.redis_url,
                     decode_responses=True,
+                    max_connections=64,
                     health_check_interval=30,
+                    socket_connect_timeout=settings.redis_connect_timeout,
+                    socket_timeout=settings.redis_socket_timeout,
                     socket_keepalive=True,
                     socket_keepalive_options={},
-                    retry_on_timeout=True
+                    # Redis变慢时快速失败回源数据库，而不是重试把延迟翻倍
+                    retry_on_timeout=False
                 )
-                # 测试连接
-                self._client.ping()
-                logger.info(f"Redis cache initialized: {settings.redis_url}")
+                # 脚本通过EVALSHA执行，首次遇到NOSCRIPT时自动SCRIPT LOAD
+                self._get_and_touch = self._client.register_script(self.GET_AND_TOUCH_SCRIPT)
             except Exception as e:
-                logger.warning(f"Redis connection failed, disabling cache: {e}")
+                logger.warning(f"Redis client creation failed, disabling cache: {e}")
                 self._enabled = False
                 self._client = None
     
+    async def initialize(self) -> None:
+        """测试Redis连接，失败时禁用缓存"""
+        if not self.enabled:
+            return
+        
+        try:
+            await self._client.ping()
+            logger.info(f"Redis cache initialized: {settings.redis_url}")
+        except Exception as e:
+            logger.warning(f"Redis connection failed, disabling cache: {e}")
+            await self.close()
+            self._enabled = False
+    
+    async def close(self) -> None:
+        """关闭Redis连接池"""
+        for client in (self._client, self._pubsub_client):
+            if client is not None:
+                try:
+                    await client.aclose()
+                except Exception as e:
+                    logger.warning(f"Error closing Redis client: {e}")
+        self._client = None
+        self._pubsub_client = None
+    
     @property
     def enabled(self) -> bool:
         """检查缓存是否可用"""
         return self._enabled and self._client is not None
     
+    @property
+    def available(self) -> bool:
+        """检查缓存是否可用且未处于熔断状态（鉴权热路径使用）"""
+        return self.enabled and time.monotonic() >= self._breaker_open_until
+    
+    def _record_failure(self) -> None:
+        """记录一次Redis调用失败，窗口内失败次数达到阈值时熔断"""
+        now = time.monotonic()
+        if now - self._failure_window_start > self.BREAKER_FAILURE_WINDOW:
+            self._failure_window_start = now
+            self._failure_count = 0
+        
+        self._failure_count += 1
+        if self._failure_count >= self.BREAKER_FAILURE_THRESHOLD:
+            # 冷却期结束后恢复访问Redis，若仍然失败会在再次达到阈值后重新熔断
+            self._breaker_open_until = now + self.BREAKER_COOLDOWN
+            self._failure_count = 0
+            logger.warning(f"Redis failing repeatedly, bypassing cache for {self.BREAKER_COOLDOWN:.0f}s")
+    
+    def hash_api_key(self, api_key: str) -> str:
+        """计算API密钥的带密钥BLAKE2b摘要（与HMAC同为安全的MAC，但只需一次哈希运算）"""
+        return hashlib.blake2b(api_key.encode(), key=self._cache_secret, digest_size=32).hexdigest()
+    
     def _get_cache_key(self, api_key: str) -> str:
         """生成缓存键"""
-        # 使用API密钥的前16个字符作为缓存键，避免完整密钥泄露
-        return f"api_key_auth:{api_key[:16]}"
+        return f"api_key_auth:{self.hash_api_key(api_key)}"
+    
+    def _get_lock_key(self, api_key: str) -> str:
+        """生成缓存回填锁的键"""
+        return f"api_key_lock:{self.hash_api_key(api_key)}"
     
-    def get_api_key_auth(self, api_key: str) -> Optional[Tuple[bool, bool]]:
+    async def acquire_refresh_lock(self, api_key: str) -> bool:
         """
-        从缓存获取API密钥验证结果
+        获取缓存回填锁（单飞），保证同一密钥缓存未命中时只有一个请求回源数据库
+        
+        Args:
+            api_key: API密钥
+            
+        Returns:
+            bool: 是否获得锁；缓存不可用时始终返回True，由调用方直接查询数据库
+        """
+        if not self.available:
+            return True
+        
+        try:
+            acquired = await self._client.set(
+                self._get_lock_key(api_key), "1", nx=True, ex=self.REFRESH_LOCK_TTL
+            )
+            return bool(acquired)
+        except Exception as e:
+            logger.error(f"Redis lock error: {e}")
+            self._record_failure()
+            return True
+    
+    async def release_refresh_lock(self, api_key: str) -> None:
+        """
+        释放缓存回填锁
+        
+        Args:
+            api_key: API密钥
+        """
+        if not self.available:
+            return
+        
+        try:
+            await self._client.delete(self._get_lock_key(api_key))
+        except Exception as e:
+            logger.error(f"Redis unlock error: {e}")
+            self._record_failure()
+    
+    async def get_api_key_auth(self, api_key: str) -> Optional[Tuple[bool, bool]]:
+        """
+        从缓存获取API密钥验证结果，命中有效结果时顺带续期
         
         Args:
             api_key: API密钥
@@ -54,26 +193,42 @@ class RedisCache:
         Returns:
             Optional[Tuple[bool, bool]]: (is_valid, is_admin) 或 None
         """
-        if not self.enabled:
+        if not self.available:
             return None
         
         try:
             cache_key = self._get_cache_key(api_key)
-            cached_data = self._client.get(cache_key)
+            now = int(time.time())
+            cached_data = await self._get_and_touch(
+                keys=[cache_key], args=[settings.api_key_cache_ttl, self.NEGATIVE_PAYLOAD, now]
+            )
             
             if cached_data:
-                data = json.loads(cached_data)
-                logger.debug(f"Cache hit for API key: {api_key[:8]}...")
-                return data.get("is_valid", False), data.get("is_admin", False)
+                if cached_data == self.NEGATIVE_PAYLOAD:
+                    logger.debug("Negative cache hit for API key: %s...", api_key[:8])
+                    return False, False
+                fields = cached_data.split(":")
+                # 滑动过期会让常用密钥一直留在缓存中，超过最大存活时间后强制回源数据库重新校验；
+                # 密钥已过期，或无法解析的旧格式条目，同样按未命中处理，回源后会被覆盖
+                if (len(fields) != 3 or not fields[1].isdigit() or not fields[2].isdigit() or
+                        now - int(fields[1]) > settings.api_key_cache_max_age or
+                        0 < int(fields[2]) <= now):
+                    logger.debug("Stale cache entry for API key: %s...", api_key[:8])
+                    return None
+                admin_flag = fields[0]
+                logger.debug("Cache hit for API key: %s...", api_key[:8])
+                return True, admin_flag == "1"
             
-            logger.debug(f"Cache miss for API key: {api_key[:8]}...")
+            logger.debug("Cache miss for API key: %s...", api_key[:8])
             return None
             
         except Exception as e:
             logger.error(f"Redis get error: {e}")
+            self._record_failure()
             return None
     
-    def set_api_key_auth(self, api_key: str, is_valid: bool, is_admin: bool) -> bool:
+    async def set_api_key_auth(self, api_key: str, is_valid: bool, is_admin: bool,
+                               release_lock: bool = False, expires_at: Optional[float] = None) -> bool:
         """
         缓存API密钥验证结果
         
@@ -81,41 +236,76 @@ class RedisCache:
             api_key: API密钥
             is_valid: 是否有效
             is_admin: 是否为管理员
+            release_lock: 是否在同一次往返中释放缓存回填锁
+            expires_at: 密钥过期的Unix时间戳，None表示永不过期；缓存不会存活到该时间之后
             
         Returns:
             bool: 是否成功缓存
         """
-        if not self.enabled:
-            return False
-        
-        # 只缓存有效的密钥，避免缓存无效密钥被暴力破解
-        if not is_valid:
+        if not self.available:
             return False
         
         try:
             cache_key = self._get_cache_key(api_key)
-            cache_data = {
-                "is_valid": is_valid,
-                "is_admin": is_admin,
-                "cached_at": datetime.utcnow().isoformat()
-            }
+            if is_valid:
+                now = int(time.time())
+                expires_at = int(expires_at) if expires_at is not None else 0
+                payload = f"{int(is_admin)}:{now}:{expires_at}"
+                ttl = settings.api_key_cache_ttl
+                if expires_at:
+                    ttl = min(ttl, expires_at - now)
+                    if ttl <= 0:
+                        # 密钥即将过期，不再缓存
+                        if release_lock:
+                            await self.release_refresh_lock(api_key)
+                        return False
+            else:
+                # 无效密钥只做短时间的负缓存，避免重复查询数据库
+                payload = self.NEGATIVE_PAYLOAD
+                ttl = settings.api_key_negative_ttl
             
-            result = self._client.setex(
-                cache_key,
-                settings.api_key_cache_ttl,
-                json.dumps(cache_data)
-            )
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.setex(cache_key, ttl, payload)
+                if release_lock:
+                    pipe.delete(self._get_lock_key(api_key))
+                result = (await pipe.execute())[0]
             
             if result:
-                logger.debug(f"Cached API key auth: {api_key[:8]}... for {settings.api_key_cache_ttl}s")
+                logger.debug("Cached API key auth: %s... for %ss", api_key[:8], ttl)
             
             return result
             
         except Exception as e:
             logger.error(f"Redis set error: {e}")
+            self._record_failure()
             return False
     
-    def invalidate_api_key(self, api_key: str) -> bool:
+    async def record_auth_failure(self, client_ip: str) -> int:
+        """
+        记录一次鉴权失败
+        
+        Args:
+            client_ip: 客户端IP
+            
+        Returns:
+            int: 当前统计窗口内该IP的失败次数，缓存不可用时返回0
+        """
+        if not self.available:
+            return 0
+        
+        try:
+            counter_key = f"auth_failures:{client_ip}"
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.set(counter_key, 0, ex=self.AUTH_FAILURE_WINDOW, nx=True)
+                pipe.incr(counter_key)
+                _, failures = await pipe.execute()
+            return int(failures)
+        except Exception as e:
+            logger.error(f"Redis incr error: {e}")
+            self._record_failure()
+            return 0
+    
+    async def invalidate_api_key(self, api_key: str) -> bool:
         """
         使特定API密钥的缓存失效
         
@@ -130,7 +320,8 @@ class RedisCache:
         
         try:
             cache_key = self._get_cache_key(api_key)
-            result = self._client.delete(cache_key)
+            result = await self._client.delete(cache_key)
+            await self._client.publish(self.INVALIDATION_CHANNEL, self.hash_api_key(api_key))
             
             if result:
                 logger.info(f"Invalidated cache for API key: {api_key[:8]}...")
@@ -141,7 +332,7 @@ class RedisCache:
             logger.error(f"Redis delete error: {e}")
             return False
     
-    def clear_all_cache(self) -> bool:
+    async def clear_all_cache(self) -> bool:
         """
         清空所有API密钥缓存
         
@@ -152,14 +343,24 @@ class RedisCache:
             return False
         
         try:
-            # 查找所有API密钥缓存
-            pattern = "api_key_auth:*"
-            keys = self._client.keys(pattern)
+            # 增量遍历所有API密钥缓存，分批 UNLINK（在Redis后台线程释放内存）
+            deleted_count = 0
+            batch = []
+            async for key in self._client.scan_iter(
+                match=self.CACHE_KEY_PATTERN, count=self.SCAN_BATCH_SIZE
+            ):
+                batch.append(key)
+                if len(batch) >= self.SCAN_BATCH_SIZE:
+                    deleted_count += await self._client.unlink(*batch)
+                    batch.clear()
+            
+            if batch:
+                deleted_count += await self._client.unlink(*batch)
             
-            if keys:
-                deleted_count = self._client.delete(*keys)
+            await self._client.publish(self.INVALIDATION_CHANNEL, self.INVALIDATE_ALL)
+            
+            if deleted_count:
                 logger.info(f"Cleared {deleted_count} API key cache entries")
-                return deleted_count > 0
             
             return True
             
@@ -167,7 +368,7 @@ class RedisCache:
             logger.error(f"Redis clear cache error: {e}")
             return False
     
-    def get_cache_stats(self) -> Dict[str, Any]:
+    async def get_cache_stats(self) -> Dict[str, Any]:
         """
         获取缓存统计信息
         
@@ -178,16 +379,19 @@ class RedisCache:
             return {"enabled": False, "error": "Redis not available"}
         
         try:
-            info = self._client.info()
-            pattern = "api_key_auth:*"
-            keys = self._client.keys(pattern)
+            info = await self._client.info()
+            cache_count = 0
+            async for _ in self._client.scan_iter(
+                match=self.CACHE_KEY_PATTERN, count=self.SCAN_BATCH_SIZE
+            ):
+                cache_count += 1
             
             return {
                 "enabled": True,
                 "redis_version": info.get("redis_version"),
                 "connected_clients": info.get("connected_clients"),
                 "used_memory_human": info.get("used_memory_human"),
-                "api_key_cache_count": len(keys),
+                "api_key_cache_count": cache_count,
                 "cache_ttl": settings.api_key_cache_ttl
             }
             
@@ -195,7 +399,7 @@ class RedisCache:
             logger.error(f"Redis stats error: {e}")
             return {"enabled": False, "error": str(e)}
     
-    def health_check(self) -> bool:
+    async def health_check(self) -> bool:
         """
         Redis健康检查
         
@@ -206,11 +410,44 @@ class RedisCache:
             return False
         
         try:
-            response = self._client.ping()
+            response = await self._client.ping()
             return response is True
         except Exception as e:
             logger.error(f"Redis health check failed: {e}")
             return False
+    
+    async def listen_invalidations(self, on_invalidate: Callable[[Optional[str]], None]) -> None:
+        """
+        订阅密钥失效通知，直到任务被取消
+        
+        Args:
+            on_invalidate: 回调函数，参数为密钥摘要，None表示全部失效
+        """
+        # 订阅连接需要无限期阻塞等待消息，使用不带socket_timeout的独立客户端
+        if self.enabled and self._pubsub_client is None:
+            self._pubsub_client = redis.from_url(
+                settings.redis_url,
+                decode_responses=True,
+                socket_connect_timeout=settings.redis_connect_timeout,
+                socket_keepalive=True
+            )
+        
+        while self.enabled:
+            pubsub = self._pubsub_client.pubsub()
+            try:
+                await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    data = message.get("data")
+                    on_invalidate(None if data == self.INVALIDATE_ALL else data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis invalidation listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
 
 
 # 全局Redis缓存实例
@@ -1,64 +1,58 @@
+import audioop
+import io
 import os
+import shutil
+import struct
+import subprocess
 import tempfile
+import wave
 import logging
-from typing import Optional
+from typing import BinaryIO, NoReturn, Optional, Tuple
 from pydub import AudioSegment
-import threading
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import itertools
 import time
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, suppress
+from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# FFmpeg是否可用只在模块加载时检查一次，避免每次创建转换器都遍历PATH
+_FFMPEG_AVAILABLE = shutil.which("ffmpeg") is not None
+if not _FFMPEG_AVAILABLE:
+    logger.warning("FFmpeg not found in PATH. Some audio formats may not be supported.")
+
 # 移除全局锁，改为并发控制
 class ConcurrencyManager:
-    """并发管理器，控制音频转换的并发数量"""
+    """并发管理器，控制音频转换的并发数量（运行在事件循环内，无需线程锁）"""
     
     def __init__(self, max_concurrent_conversions: int = 10):
-        self.semaphore = threading.Semaphore(max_concurrent_conversions)
+        self.semaphore = asyncio.Semaphore(max_concurrent_conversions)
         self.active_conversions = 0
         self.total_conversions = 0
-        self.lock = threading.Lock()
         
-    @contextmanager
-    def acquire_conversion_slot(self):
+    @asynccontextmanager
+    async def acquire_conversion_slot(self):
         """获取转换槽位"""
-        self.semaphore.acquire()
-        try:
-            with self.lock:
-                self.active_conversions += 1
-                self.total_conversions += 1
-            yield
-        finally:
-            with self.lock:
+        async with self.semaphore:
+            self.active_conversions += 1
+            self.total_conversions += 1
+            try:
+                yield
+            finally:
                 self.active_conversions -= 1
-            self.semaphore.release()
     
     def get_stats(self) -> dict:
         """获取并发统计"""
-        with self.lock:
-            return {
-                "active_conversions": self.active_conversions,
-                "total_conversions": self.total_conversions
-            }
+        return {
+            "active_conversions": self.active_conversions,
+            "total_conversions": self.total_conversions
+        }
 
 # 全局并发管理器（使用settings配置）
-def get_concurrency_manager():
-    """获取并发管理器实例"""
-    from config.settings import settings
-    return ConcurrencyManager(
-        max_concurrent_conversions=settings.max_concurrent_audio_conversions
-    )
-
-_concurrency_manager = None
-
-def _get_global_concurrency_manager():
-    """获取全局并发管理器"""
-    global _concurrency_manager
-    if _concurrency_manager is None:
-        _concurrency_manager = get_concurrency_manager()
-    return _concurrency_manager
+_concurrency_manager = ConcurrencyManager(
+    max_concurrent_conversions=settings.max_concurrent_audio_conversions
+)
 
 
 class AudioConverter:
@@ -85,18 +79,15 @@ class AudioConverter:
     
     def __init__(self):
         """初始化音频转换器"""
-        self._validate_ffmpeg()
+        if settings.temp_dir:
+            os.makedirs(settings.temp_dir, exist_ok=True)
         self.conversion_count = 0
-        self.local_lock = threading.Lock()
+        self._conversion_counter = itertools.count(1)
     
-    def _validate_ffmpeg(self) -> None:
-        """验证FFmpeg是否可用"""
-        try:
-            from pydub.utils import which
-            if not which("ffmpeg"):
-                logger.warning("FFmpeg not found in PATH. Some audio formats may not be supported.")
-        except Exception as e:
-            logger.warning(f"Could not verify FFmpeg installation: {e}")
+    @staticmethod
+    def _get_extension(file_path: str) -> str:
+        """获取小写且不带点的文件扩展名"""
+        return os.path.splitext(file_path)[1].lower().lstrip('.')
     
     def get_audio_format(self, file_path: str) -> str:
         """
@@ -108,7 +99,7 @@ class AudioConverter:
         Returns:
             str: 音频格式
         """
-        extension = os.path.splitext(file_path)[1].lower().lstrip('.')
+        extension = self._get_extension(file_path)
         return self.SUPPORTED_INPUT_FORMATS.get(extension, extension)
     
     def is_format_supported(self, file_path: str) -> bool:
@@ -121,31 +112,32 @@ class AudioConverter:
         Returns:
             bool: 是否支持该格式
         """
-        extension = os.path.splitext(file_path)[1].lower().lstrip('.')
+        extension = self._get_extension(file_path)
         return extension in self.SUPPORTED_INPUT_FORMATS
     
-    def needs_conversion(self, file_path: str) -> bool:
+    def needs_conversion(self, file_path: str, head: Optional[bytes] = None) -> bool:
         """
         检查文件是否需要转换
         
         Args:
             file_path: 音频文件路径
+            head: 已读取的文件开头字节，提供时优先从中解析WAV文件头，避免再次打开文件
             
         Returns:
             bool: 是否需要转换
         """
-        extension = os.path.splitext(file_path)[1].lower().lstrip('.')
+        extension = self._get_extension(file_path)
         
         # 如果不是WAV格式，肯定需要转换
         if extension != 'wav':
             return True
             
         # 如果是WAV格式，检查是否兼容我们的要求
-        return not self._is_wav_compatible(file_path)
+        return not self._is_wav_compatible(file_path, head)
     
     def convert_to_wav(self, input_path: str, output_path: Optional[str] = None) -> str:
         """
-        将音频文件转换为WAV格式（高并发优化版本）
+        将音频文件转换为WAV格式（同步版本，不占用全局并发槽位，服务内请使用AsyncAudioConverter）
         
         Args:
             input_path: 输入音频文件路径
@@ -158,87 +150,242 @@ class AudioConverter:
             ValueError: 不支持的音频格式
             IOError: 转换失败
         """
-        if not os.path.exists(input_path):
-            raise IOError(f"Input file does not exist: {input_path}")
+        target_path, header = self._prepare_conversion(input_path, output_path)
+        if target_path is None:
+            return input_path
+        
+        start_time = time.time()
+        try:
+            logger.info("Converting %s to WAV format (conversion #%d)", input_path, self._next_conversion_number())
+            
+            if not self._convert_wav_native(input_path, target_path, header):
+                # 一次FFmpeg调用完成解码、重采样、声道和位深转换，PCM数据不经过Python内存
+                result = subprocess.run(
+                    self._build_ffmpeg_command(input_path, target_path),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE
+                )
+                self._check_ffmpeg_result(result.returncode, result.stderr)
+            
+            logger.info("Successfully converted to: %s in %.2fs", target_path, time.time() - start_time)
+            return target_path
+            
+        except Exception as e:
+            self._handle_conversion_failure(input_path, target_path, e)
+    
+    def _prepare_conversion(self, input_path: str, output_path: Optional[str]) -> Tuple[Optional[str], Optional[tuple]]:
+        """
+        校验输入文件并确定输出路径
         
-        if not self.is_format_supported(input_path):
-            extension = os.path.splitext(input_path)[1].lower().lstrip('.')
+        Args:
+            input_path: 输入音频文件路径
+            output_path: 输出WAV文件路径，如果为None则创建临时文件
+            
+        Returns:
+            Tuple[Optional[str], Optional[tuple]]: 输出WAV文件路径（输入已是兼容WAV时为None），
+                                                   以及已解析的WAV文件头（非WAV或无法解析时为None），供转换时复用
+        """
+        # 不预先检查输入文件是否存在：读取文件头或FFmpeg打开文件时自然会失败，由失败路径报告原因
+        extension = self._get_extension(input_path)
+        if extension not in self.SUPPORTED_INPUT_FORMATS:
             raise ValueError(f"Unsupported audio format: {extension}")
         
-        # 如果已经是WAV格式，检查是否符合要求
-        if not self.needs_conversion(input_path):
-            if self._is_wav_compatible(input_path):
-                logger.info(f"File {input_path} is already in compatible WAV format")
-                return input_path
+        # 如果已经是WAV格式，检查是否符合要求（只读取一次文件头，进程内转换时复用）
+        header = None
+        if extension == 'wav':
+            try:
+                header = self._read_wav_header(input_path)
+            except OSError:
+                header = None
+            if self._is_header_compatible(input_path, header):
+                logger.info("File %s is already in compatible WAV format", input_path)
+                return None, header
         
         # 生成输出路径
         if output_path is None:
-            temp_fd, output_path = tempfile.mkstemp(suffix='.wav', prefix='lingualink_converted_')
+            temp_fd, output_path = tempfile.mkstemp(
+                suffix='.wav', prefix='lingualink_converted_', dir=settings.temp_dir
+            )
             os.close(temp_fd)  # 关闭文件描述符，但保留文件路径
         
-        start_time = time.time()
+        return output_path, header
+    
+    def _next_conversion_number(self) -> int:
+        """递增并返回本实例的转换计数（itertools.count在GIL下原子递增，无需加锁）"""
+        self.conversion_count = next(self._conversion_counter)
+        return self.conversion_count
+    
+    @staticmethod
+    def _check_ffmpeg_result(returncode: int, stderr: bytes) -> None:
+        """FFmpeg非零退出时抛出带错误输出的IOError"""
+        if returncode != 0:
+            message = stderr.decode('utf-8', errors='replace').strip()
+            raise IOError(f"ffmpeg exited with code {returncode}: {message}")
+    
+    @staticmethod
+    def _handle_conversion_failure(input_path: str, output_path: str, error: Exception) -> NoReturn:
+        """清理失败的输出文件并抛出IOError"""
+        if output_path:
+            with suppress(OSError):
+                os.remove(output_path)
         
-        # 使用并发管理器进行转换
-        concurrency_manager = _get_global_concurrency_manager()
-        with concurrency_manager.acquire_conversion_slot():
-            try:
-                with self.local_lock:
-                    self.conversion_count += 1
-                    current_count = self.conversion_count
-                
-                logger.info(f"Converting {input_path} to WAV format (conversion #{current_count})")
-                
-                # 获取输入格式
-                input_format = self.get_audio_format(input_path)
-                
-                # 加载音频文件
-                if input_format == 'opus':
-                    # OPUS需要特殊处理
-                    audio = AudioSegment.from_file(input_path, format="ogg", codec="libopus")
-                else:
-                    audio = AudioSegment.from_file(input_path, format=input_format)
-                
-                # 转换为标准WAV格式
-                audio = audio.set_frame_rate(self.WAV_CONFIG['frame_rate'])
-                audio = audio.set_channels(self.WAV_CONFIG['channels'])
-                audio = audio.set_sample_width(self.WAV_CONFIG['sample_width'])
-                
-                # 导出为WAV
-                audio.export(
-                    output_path,
-                    format=self.WAV_CONFIG['format'],
-                    parameters=["-ar", str(self.WAV_CONFIG['frame_rate'])]
-                )
-                
-                conversion_time = time.time() - start_time
-                stats = concurrency_manager.get_stats()
-                
-                logger.info(f"Successfully converted to: {output_path} in {conversion_time:.2f}s "
-                          f"(active: {stats['active_conversions']}, total: {stats['total_conversions']})")
-                return output_path
-                
-            except Exception as e:
-                # 清理失败的输出文件
-                if output_path and os.path.exists(output_path):
-                    try:
-                        os.remove(output_path)
-                    except:
-                        pass
-                
-                error_msg = f"Failed to convert audio file {input_path}: {e}"
-                logger.error(error_msg)
-                raise IOError(error_msg)
+        # 只在失败时确认输入文件是否存在，成功路径上不多做一次stat
+        if not os.path.exists(input_path):
+            error_msg = f"Input file does not exist: {input_path}"
+        else:
+            error_msg = f"Failed to convert audio file {input_path}: {error}"
+        logger.error(error_msg)
+        raise IOError(error_msg)
     
-    def _is_wav_compatible(self, wav_path: str) -> bool:
+    def _build_ffmpeg_command(self, input_path: str, output_path: str) -> list:
+        """
+        构建将音频转换为标准WAV格式的FFmpeg命令
+        
+        Args:
+            input_path: 输入音频文件路径
+            output_path: 输出WAV文件路径
+            
+        Returns:
+            list: FFmpeg命令参数
+        """
+        return [
+            "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+            "-i", input_path,
+            "-ar", str(self.WAV_CONFIG['frame_rate']),
+            "-ac", str(self.WAV_CONFIG['channels']),
+            "-sample_fmt", f"s{self.WAV_CONFIG['sample_width'] * 8}",
+            "-f", self.WAV_CONFIG['format'],
+            output_path
+        ]
+    
+    def _convert_wav_native(self, input_path: str, output_path: str, header: Optional[tuple]) -> bool:
+        """
+        采样率已符合要求的PCM WAV只需调整声道和位深，在进程内完成，无需启动FFmpeg
+        
+        Args:
+            input_path: 输入WAV文件路径
+            output_path: 输出WAV文件路径
+            header: _prepare_conversion已解析的WAV文件头，非WAV或无法解析时为None
+            
+        Returns:
+            bool: 是否已完成转换，False表示需要交给FFmpeg（如需要重采样）
+        """
+        # audioop的线性插值重采样没有抗混叠滤波，采样率不同时仍由FFmpeg处理
+        if (header is None or header[0] != 1 or
+                header[2] != self.WAV_CONFIG['frame_rate'] or
+                header[1] not in (1, 2) or header[3] not in (8, 16, 24, 32)):
+            return False
+        
+        try:
+            with wave.open(input_path, 'rb') as src:
+                channels = src.getnchannels()
+                sample_width = src.getsampwidth()
+                frames = src.readframes(src.getnframes())
+        except (wave.Error, EOFError) as e:
+            logger.debug("Native WAV conversion not possible for %s: %s", input_path, e)
+            return False
+        
+        target_width = self.WAV_CONFIG['sample_width']
+        if sample_width == 1:
+            # 8位WAV是无符号采样，audioop按有符号处理
+            frames = audioop.bias(frames, 1, -128)
+        if sample_width != target_width:
+            frames = audioop.lin2lin(frames, sample_width, target_width)
+        if channels == 2:
+            frames = audioop.tomono(frames, target_width, 0.5, 0.5)
+        
+        with wave.open(output_path, 'wb') as dst:
+            dst.setnchannels(self.WAV_CONFIG['channels'])
+            dst.setsampwidth(target_width)
+            dst.setframerate(self.WAV_CONFIG['frame_rate'])
+            dst.writeframes(frames)
+        return True
+    
+    def _read_wav_header(self, wav_path: str, head: Optional[bytes] = None) -> Optional[tuple]:
+        """
+        只读取WAV文件头，解析fmt块
+        
+        Args:
+            wav_path: WAV文件路径
+            head: 已读取的文件开头字节，fmt块完整包含在其中时无需打开文件
+            
+        Returns:
+            Optional[tuple]: (audio_format, channels, sample_rate, bits_per_sample)，
+                             文件头无法解析时返回None
+        """
+        if head is not None:
+            header = self._parse_wav_header(io.BytesIO(head))
+            # 解析成功，或开头就不是RIFF/WAVE时，结果已确定；否则fmt块可能在head之外，回退读取文件
+            if header is not None or head[:4] != b'RIFF' or head[8:12] != b'WAVE':
+                return header
+        
+        with open(wav_path, 'rb') as f:
+            return self._parse_wav_header(f)
+    
+    @staticmethod
+    def _parse_wav_header(f: BinaryIO) -> Optional[tuple]:
+        """从文件对象开头解析RIFF/WAVE的fmt块，格式同_read_wav_header"""
+        riff_header = f.read(12)
+        if len(riff_header) < 12 or riff_header[:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+            return None
+        
+        # fmt块之前可能还有其他块（如JUNK、LIST），逐个跳过
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = f.read(16)
+                if len(fmt) < 16:
+                    return None
+                audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt)
+                return audio_format, channels, sample_rate, bits_per_sample
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    
+    def _is_wav_compatible(self, wav_path: str, head: Optional[bytes] = None) -> bool:
         """
         检查WAV文件是否符合要求的格式
         
         Args:
             wav_path: WAV文件路径
+            head: 已读取的文件开头字节（可选）
             
         Returns:
             bool: 是否兼容
         """
+        try:
+            header = self._read_wav_header(wav_path, head)
+        except OSError:
+            return False
+        return self._is_header_compatible(wav_path, header)
+    
+    def _is_header_compatible(self, wav_path: str, header: Optional[tuple]) -> bool:
+        """
+        根据已解析的WAV文件头检查是否符合要求的格式
+        
+        Args:
+            wav_path: WAV文件路径（非PCM编码时回退到pydub解析）
+            header: _read_wav_header的解析结果
+            
+        Returns:
+            bool: 是否兼容
+        """
+        # 没有RIFF/WAVE标识（如扩展名为.wav的其他格式），直接交给FFmpeg转换，不再尝试解码
+        if header is None:
+            return False
+        
+        # PCM格式直接根据文件头判断，无需解码整个文件
+        if header[0] == 1:
+            _, channels, sample_rate, bits_per_sample = header
+            return (
+                sample_rate == self.WAV_CONFIG['frame_rate'] and
+                channels == self.WAV_CONFIG['channels'] and
+                bits_per_sample == self.WAV_CONFIG['sample_width'] * 8
+            )
+        
+        # 非PCM编码（如浮点、WAVE_FORMAT_EXTENSIBLE）时，回退到pydub解析
         try:
             audio = AudioSegment.from_wav(wav_path)
             return (
@@ -249,9 +396,79 @@ class AudioConverter:
         except Exception:
             return False
     
+    # Ogg页头长度及其中颗粒位置（granule position）的偏移
+    _OGG_PAGE_HEADER_SIZE = 27
+    _OGG_GRANULE_OFFSET = 6
+    # 从文件末尾读取多少字节查找最后一个Ogg页
+    _OGG_TAIL_SIZE = 64 * 1024
+    
+    def _probe_opus(self, file_path: str) -> Optional[tuple]:
+        """
+        只读取Ogg页头解析Opus文件信息，无需解码
+        
+        Args:
+            file_path: Opus文件路径
+            
+        Returns:
+            Optional[tuple]: (duration_seconds, frame_rate, channels, sample_width)，无法解析时返回None
+        """
+        with open(file_path, 'rb') as f:
+            first_page = f.read(self._OGG_PAGE_HEADER_SIZE + 255 + 19)
+            if len(first_page) < self._OGG_PAGE_HEADER_SIZE or first_page[:4] != b'OggS':
+                return None
+            
+            # 第一个页的第一个包是OpusHead：魔数(8) 版本(1) 声道数(1) pre-skip(2) 原始采样率(4)
+            segment_count = first_page[26]
+            packet_start = self._OGG_PAGE_HEADER_SIZE + segment_count
+            opus_head = first_page[packet_start:packet_start + 19]
+            if len(opus_head) < 19 or opus_head[:8] != b'OpusHead':
+                return None
+            channels = opus_head[9]
+            pre_skip = struct.unpack_from('<H', opus_head, 10)[0]
+            
+            # 时长取自最后一个页的颗粒位置（以48kHz采样计）
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            tail_start = max(0, file_size - self._OGG_TAIL_SIZE)
+            f.seek(tail_start)
+            tail = f.read()
+        
+        position = len(tail)
+        while True:
+            position = tail.rfind(b'OggS', 0, position)
+            if position < 0:
+                return None
+            header = tail[position:position + self._OGG_PAGE_HEADER_SIZE]
+            if len(header) == self._OGG_PAGE_HEADER_SIZE and header[4] == 0:
+                granule = struct.unpack_from('<q', header, self._OGG_GRANULE_OFFSET)[0]
+                # -1表示该页没有结束的包，继续向前查找
+                if granule >= 0:
+                    break
+        
+        # Opus总是解码为48kHz，与pydub/FFmpeg解码结果一致
+        duration = max(0, granule - pre_skip) / 48000.0
+        return duration, 48000, channels, 2
+    
+    @staticmethod
+    def _probe_wav(file_path: str) -> Optional[tuple]:
+        """只读取WAV文件头获取音频信息，格式同_probe_opus"""
+        try:
+            with wave.open(file_path, 'rb') as wav_file:
+                frame_rate = wav_file.getframerate()
+                if not frame_rate:
+                    return None
+                return (
+                    wav_file.getnframes() / frame_rate,
+                    frame_rate,
+                    wav_file.getnchannels(),
+                    wav_file.getsampwidth()
+                )
+        except (wave.Error, EOFError):
+            return None
+    
     def get_audio_info(self, file_path: str) -> dict:
         """
-        获取音频文件信息
+        获取音频文件信息（Opus和WAV只解析文件头，其他格式或解析失败时用pydub解码）
         
         Args:
             file_path: 音频文件路径
@@ -265,18 +482,29 @@ class AudioConverter:
             
             input_format = self.get_audio_format(file_path)
             
+            probe = None
             if input_format == 'opus':
-                audio = AudioSegment.from_file(file_path, format="ogg", codec="libopus")
+                probe = self._probe_opus(file_path)
+            elif input_format == 'wav':
+                probe = self._probe_wav(file_path)
+            
+            if probe is not None:
+                duration_seconds, frame_rate, channels, sample_width = probe
             else:
-                audio = AudioSegment.from_file(file_path, format=input_format)
+                if input_format == 'opus':
+                    audio = AudioSegment.from_file(file_path, format="ogg", codec="libopus")
+                else:
+                    audio = AudioSegment.from_file(file_path, format=input_format)
+                duration_seconds = len(audio) / 1000.0
+                frame_rate, channels, sample_width = audio.frame_rate, audio.channels, audio.sample_width
             
             return {
                 "exists": True,
                 "format": input_format,
-                "duration_seconds": len(audio) / 1000.0,
-                "frame_rate": audio.frame_rate,
-                "channels": audio.channels,
-                "sample_width": audio.sample_width,
+                "duration_seconds": duration_seconds,
+                "frame_rate": frame_rate,
+                "channels": channels,
+                "sample_width": sample_width,
                 "needs_conversion": self.needs_conversion(file_path)
             }
         except Exception as e:
@@ -298,11 +526,12 @@ class AudioConverter:
             bool: 清理是否成功
         """
         # 只清理转换生成的文件，不清理原始文件
-        if file_path != original_path and os.path.exists(file_path):
+        if file_path != original_path:
             try:
                 os.remove(file_path)
-                logger.info(f"Converted file {file_path} cleaned up")
-                return True
+                logger.info("Converted file %s cleaned up", file_path)
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 logger.error(f"Failed to cleanup converted file {file_path}: {e}")
                 return False
@@ -310,31 +539,24 @@ class AudioConverter:
     
     def get_conversion_stats(self) -> dict:
         """获取转换统计信息"""
-        concurrency_manager = _get_global_concurrency_manager()
-        global_stats = concurrency_manager.get_stats()
-        with self.local_lock:
-            local_stats = {"instance_conversions": self.conversion_count}
-        
-        return {**global_stats, **local_stats}
+        return {
+            **_concurrency_manager.get_stats(),
+            "instance_conversions": self.conversion_count
+        }
 
 
 # 异步音频转换器（用于高并发场景）
 class AsyncAudioConverter:
-    """异步音频转换器，适合高并发Web应用"""
+    """异步音频转换器，直接以子进程运行FFmpeg，不占用线程池"""
     
-    def __init__(self, max_workers: Optional[int] = None):
+    def __init__(self, converter: Optional[AudioConverter] = None):
         """
         初始化异步转换器
         
         Args:
-            max_workers: 最大工作线程数，如果为None则从settings获取
+            converter: 共享的同步转换器（提供格式检测和命令构建），为None时新建
         """
-        if max_workers is None:
-            from config.settings import settings
-            max_workers = settings.audio_converter_workers
-            
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-        self.sync_converter = AudioConverter()
+        self.sync_converter = converter or AudioConverter()
         
     async def convert_to_wav_async(self, input_path: str, output_path: Optional[str] = None) -> str:
         """
@@ -346,16 +568,48 @@ class AsyncAudioConverter:
             
         Returns:
             str: 输出WAV文件路径
+            
+        Raises:
+            ValueError: 不支持的音频格式
+            IOError: 转换失败
         """
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            self.executor,
-            self.sync_converter.convert_to_wav,
-            input_path,
-            output_path
-        )
-    
-    def __del__(self):
-        """清理资源"""
-        if hasattr(self, 'executor'):
-            self.executor.shutdown(wait=True) 
\ No newline at end of file
+        converter = self.sync_converter
+        target_path, header = converter._prepare_conversion(input_path, output_path)
+        if target_path is None:
+            return input_path
+        
+        start_time = time.time()
+        async with _concurrency_manager.acquire_conversion_slot():
+            try:
+                logger.info("Converting %s to WAV format (conversion #%d)", input_path, converter._next_conversion_number())
+                
+                if await asyncio.to_thread(converter._convert_wav_native, input_path, target_path, header):
+                    logger.info("Successfully converted to: %s in %.2fs", target_path, time.time() - start_time)
+                    return target_path
+                
+                process = await asyncio.create_subprocess_exec(
+                    *converter._build_ffmpeg_command(input_path, target_path),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    _, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    # 请求被取消时结束FFmpeg进程，避免遗留子进程
+                    process.kill()
+                    await process.wait()
+                    raise
+                converter._check_ffmpeg_result(process.returncode, stderr)
+                
+                logger.info("Successfully converted to: %s in %.2fs", target_path, time.time() - start_time)
+                logger.debug("Conversion slots (active: %d, total: %d)",
+                             _concurrency_manager.active_conversions, _concurrency_manager.total_conversions)
+                return target_path
+                
+            except asyncio.CancelledError:
+                with suppress(FileNotFoundError):
+                    os.remove(target_path)
+                raise
+            except Exception as e:
+                converter._handle_conversion_failure(input_path, target_path, e)
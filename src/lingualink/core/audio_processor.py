@@ -1,8 +1,12 @@
+import asyncio
+import itertools
 import os
 import tempfile
 import time
-from typing import List, Optional, Tuple
-from werkzeug.utils import secure_filename
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import BinaryIO, List, Optional, Tuple
 from fastapi import UploadFile
 from config.settings import settings
 import logging
@@ -11,28 +15,41 @@ from .audio_converter import AudioConverter, AsyncAudioConverter
 logger = logging.getLogger(__name__)
 
 
+@dataclass(slots=True)
+class SavedUpload:
+    """已保存到临时目录的上传文件"""
+    path: str
+    size: int
+    head: bytes
+
+
 class AudioProcessor:
     """音频处理器类，处理音频文件的上传、验证、转换和临时存储（高并发优化版本）"""
     
+    # 上传文件分块写入磁盘时的块大小
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    # 写入时保留的文件开头字节数，足以容纳RIFF头和紧随其后的fmt块
+    UPLOAD_HEAD_SIZE = 64
+    # 用于计算平均处理时间的最近请求数量
+    RECENT_TIMINGS_SIZE = 1000
+    
     def __init__(self):
         self.max_upload_size = settings.max_upload_size
-        self.allowed_extensions = set(settings.allowed_extensions)
+        self.allowed_extensions = frozenset(ext.lower().lstrip('.') for ext in settings.allowed_extensions)
         # 使用异步音频转换器以提升并发性能
         self.audio_converter = AudioConverter()
-        self.async_audio_converter = AsyncAudioConverter()  # 自动从settings获取配置
+        self.async_audio_converter = AsyncAudioConverter(self.audio_converter)
         self.request_count = 0
+        self._request_counter = itertools.count(1)
         self.total_processing_time = 0.0
+        # 只保留最近请求的耗时，平均值在查询统计时按最近请求计算
+        self._recent_processing_times = deque(maxlen=self.RECENT_TIMINGS_SIZE)
     
     def is_allowed_file(self, filename: str) -> bool:
         """检查文件扩展名是否被允许"""
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+        return os.path.splitext(filename)[1].lower().lstrip('.') in self.allowed_extensions
     
-    def validate_file_size(self, content: bytes) -> bool:
-        """验证文件大小"""
-        return len(content) <= self.max_upload_size
-    
-    async def save_upload_file(self, upload_file: UploadFile) -> str:
+    async def save_upload_file(self, upload_file: UploadFile) -> SavedUpload:
         """
         保存上传的文件到临时目录
         
@@ -40,7 +57,7 @@ class AudioProcessor:
             upload_file: FastAPI UploadFile对象
             
         Returns:
-            str: 保存的文件路径
+            SavedUpload: 保存的文件路径、大小和开头字节
             
         Raises:
             ValueError: 文件验证失败
@@ -50,42 +67,127 @@ class AudioProcessor:
             raise ValueError("No filename provided")
         
         if not self.is_allowed_file(upload_file.filename):
-            raise ValueError(f"File type not allowed. Allowed extensions: {self.allowed_extensions}")
+            raise ValueError(f"File type not allowed. Allowed extensions: {', '.join(sorted(self.allowed_extensions))}")
         
-        # 读取文件内容
-        content = await upload_file.read()
+        # 已知大小的上传直接拒绝，无需创建临时文件
+        if upload_file.size is not None and upload_file.size > self.max_upload_size:
+            raise ValueError(self._file_too_large_message())
         
-        if not content:
-            raise ValueError("Empty file uploaded")
+        # 写入磁盘并校验大小，在线程中执行，避免阻塞事件循环
+        saved = await asyncio.to_thread(
+            self._write_temp_file, upload_file.filename, upload_file.file
+        )
         
-        if not self.validate_file_size(content):
-            max_size_mb = self.max_upload_size / (1024 * 1024)
-            raise ValueError(f"File too large. Maximum size: {max_size_mb:.1f}MB")
+        logger.info("File saved: %s -> %s (%d bytes)", upload_file.filename, saved.path, saved.size)
+        return saved
+    
+    def _write_temp_file(self, filename: str, source: BinaryIO) -> SavedUpload:
+        """
+        将上传内容写入临时文件（同步，在线程中调用）；已落盘的上传通过sendfile复制，否则分块复制，内存中最多只保留一个块
         
-        # 安全的文件名
-        safe_filename = secure_filename(upload_file.filename)
+        Args:
+            filename: 原始文件名
+            source: 上传文件对象
+            
+        Returns:
+            SavedUpload: 临时文件路径、文件大小和开头字节
+            
+        Raises:
+            ValueError: 文件为空或超过大小限制
+            IOError: 文件保存失败
+        """
+        # 文件名唯一性由mkstemp保证，后缀只保留扩展名，无需清洗用户提供的文件名
+        extension = os.path.splitext(filename)[1].lower()
         
         # 创建临时文件
-        _, temp_path = tempfile.mkstemp(
-            suffix=f"_{safe_filename}",
-            prefix="lingualink_upload_"
+        temp_fd, temp_path = tempfile.mkstemp(
+            suffix=extension,
+            prefix="lingualink_upload_",
+            dir=settings.temp_dir
         )
         
         try:
-            # 保存文件内容
-            with open(temp_path, 'wb') as temp_file:
-                temp_file.write(content)
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                copied = None
+                in_fd = self._disk_fileno(source)
+                if in_fd is not None:
+                    copied = self._copy_with_sendfile(source, in_fd, temp_file.fileno())
+                if copied is None:
+                    copied = self._copy_in_chunks(source, temp_file)
+                file_size, head = copied
+            
+            if file_size == 0:
+                raise ValueError("Empty file uploaded")
             
-            logger.info(f"File saved: {upload_file.filename} -> {temp_path} "
-                       f"({len(content)} bytes)")
-            return temp_path
+            return SavedUpload(path=temp_path, size=file_size, head=head)
             
         except Exception as e:
-            # 清理失败的文件
-            if os.path.exists(temp_path):
+            # 清理失败的文件（直接删除，不存在时忽略，避免先stat再删除）
+            with suppress(FileNotFoundError):
                 os.remove(temp_path)
+            if isinstance(e, ValueError):
+                raise
             raise IOError(f"Failed to save uploaded file: {e}")
     
+    @staticmethod
+    def _disk_fileno(source: BinaryIO) -> Optional[int]:
+        """返回已落盘的上传文件的文件描述符，内容仍在内存中或平台不支持sendfile时返回None"""
+        if not hasattr(os, 'sendfile'):
+            return None
+        # SpooledTemporaryFile.fileno()会强制把内存中的内容写到磁盘；内容仍在内存中时其name为None，不取描述符
+        if isinstance(source, tempfile.SpooledTemporaryFile) and source.name is None:
+            return None
+        try:
+            return source.fileno()
+        except (AttributeError, OSError):
+            return None
+    
+    def _copy_with_sendfile(self, source: BinaryIO, in_fd: int, out_fd: int) -> Optional[Tuple[int, bytes]]:
+        """
+        通过sendfile在内核中复制已落盘的上传内容，数据不经过用户态
+        
+        Returns:
+            Optional[Tuple[int, bytes]]: 文件大小和开头字节，文件系统不支持sendfile时返回None
+        """
+        offset = source.tell()
+        file_size = os.fstat(in_fd).st_size - offset
+        if file_size > self.max_upload_size:
+            raise ValueError(self._file_too_large_message())
+        
+        # pread和带偏移的sendfile都不移动源文件的读取位置，回退到分块复制时无需重新定位
+        head = os.pread(in_fd, self.UPLOAD_HEAD_SIZE, offset)
+        copied = 0
+        while copied < file_size:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset + copied, file_size - copied)
+            except OSError:
+                if copied == 0:
+                    return None
+                raise
+            if sent == 0:
+                break
+            copied += sent
+        return copied, head
+    
+    def _copy_in_chunks(self, source: BinaryIO, temp_file: BinaryIO) -> Tuple[int, bytes]:
+        """分块读取上传内容写入临时文件，返回文件大小和开头字节"""
+        file_size = 0
+        head = b''
+        while chunk := source.read(self.UPLOAD_CHUNK_SIZE):
+            if len(head) < self.UPLOAD_HEAD_SIZE:
+                head += chunk[:self.UPLOAD_HEAD_SIZE - len(head)]
+            file_size += len(chunk)
+            # 超过大小限制时立即中止，不再继续读取剩余内容
+            if file_size > self.max_upload_size:
+                raise ValueError(self._file_too_large_message())
+            temp_file.write(chunk)
+        return file_size, head
+    
+    def _file_too_large_message(self) -> str:
+        """生成文件超过大小限制时的错误信息"""
+        max_size_mb = self.max_upload_size / (1024 * 1024)
+        return f"File too large. Maximum size: {max_size_mb:.1f}MB"
+    
     async def process_and_convert_audio(self, upload_file: UploadFile) -> Tuple[str, str]:
         """
         处理上传的音频文件，如果需要则转换为WAV格式（高并发优化版本）
@@ -101,47 +203,43 @@ class AudioProcessor:
             IOError: 文件处理失败
         """
         start_time = time.time()
-        self.request_count += 1
-        current_request = self.request_count
+        current_request = self.request_count = next(self._request_counter)
         
-        logger.info(f"Processing audio request #{current_request}: {upload_file.filename}")
+        logger.info("Processing audio request #%d: %s", current_request, upload_file.filename)
         
         # 首先保存原始文件
-        original_file_path = await self.save_upload_file(upload_file)
+        saved = await self.save_upload_file(upload_file)
+        original_file_path = saved.path
         
         try:
-            # 检查是否需要转换
-            if self.audio_converter.needs_conversion(original_file_path):
-                logger.info(f"Converting audio file #{current_request}: {upload_file.filename}")
+            # 检查是否需要转换（WAV文件头直接从保存时保留的开头字节解析）
+            if self.audio_converter.needs_conversion(original_file_path, saved.head):
+                logger.info("Converting audio file #%d: %s", current_request, upload_file.filename)
                 
                 # 使用异步转换器进行转换
                 conversion_start = time.time()
                 wav_file_path = await self.async_audio_converter.convert_to_wav_async(original_file_path)
                 conversion_time = time.time() - conversion_start
                 
-                # 验证转换后的文件
-                if not os.path.exists(wav_file_path):
-                    raise IOError("Audio conversion failed - output file not created")
-                
                 total_time = time.time() - start_time
-                self.total_processing_time += total_time
-                
-                # 获取转换统计信息
-                stats = self.audio_converter.get_conversion_stats()
+                self._record_processing_time(total_time)
                 
-                logger.info(f"Audio conversion completed #{current_request}: "
-                          f"{original_file_path} -> {wav_file_path} "
-                          f"(conversion: {conversion_time:.2f}s, total: {total_time:.2f}s, "
-                          f"active: {stats.get('active_conversions', 0)})")
+                if logger.isEnabledFor(logging.INFO):
+                    # 获取转换统计信息
+                    stats = self.audio_converter.get_conversion_stats()
+                    logger.info("Audio conversion completed #%d: %s -> %s "
+                                "(conversion: %.2fs, total: %.2fs, active: %d)",
+                                current_request, original_file_path, wav_file_path,
+                                conversion_time, total_time, stats.get('active_conversions', 0))
                 
                 return wav_file_path, original_file_path
             else:
                 # 已经是WAV格式，直接返回
                 total_time = time.time() - start_time
-                self.total_processing_time += total_time
+                self._record_processing_time(total_time)
                 
-                logger.info(f"Audio file #{current_request} is already in WAV format: "
-                          f"{upload_file.filename} (processed in {total_time:.2f}s)")
+                logger.info("Audio file #%d is already in WAV format: %s (%d bytes, processed in %.2fs)",
+                            current_request, upload_file.filename, saved.size, total_time)
                 return original_file_path, original_file_path
                 
         except Exception as e:
@@ -149,7 +247,7 @@ class AudioProcessor:
             self.cleanup_temp_file(original_file_path)
             
             if "Unsupported audio format" in str(e):
-                raise ValueError(f"Unsupported audio format. Supported formats: {', '.join(self.allowed_extensions)}")
+                raise ValueError(f"Unsupported audio format. Supported formats: {', '.join(sorted(self.allowed_extensions))}")
             else:
                 raise IOError(f"Audio processing failed: {e}")
     
@@ -163,11 +261,12 @@ class AudioProcessor:
         Returns:
             bool: 清理是否成功
         """
-        if file_path and os.path.exists(file_path):
+        if file_path:
             try:
                 os.remove(file_path)
-                logger.info(f"Temporary file {file_path} deleted.")
-                return True
+                logger.info("Temporary file %s deleted.", file_path)
+            except FileNotFoundError:
+                pass
             except Exception as e:
                 logger.error(f"Error deleting temporary file {file_path}: {e}")
                 return False
@@ -188,6 +287,16 @@ class AudioProcessor:
         # 清理原始文件
         self.cleanup_temp_file(original_file_path)
     
+    async def cleanup_audio_files_async(self, wav_file_path: str, original_file_path: str) -> None:
+        """
+        在线程中清理音频临时文件，避免删除文件的系统调用阻塞事件循环
+        
+        Args:
+            wav_file_path: WAV文件路径
+            original_file_path: 原始文件路径
+        """
+        await asyncio.to_thread(self.cleanup_audio_files, wav_file_path, original_file_path)
+    
     def get_file_info(self, file_path: str) -> dict:
         """
         获取文件信息
@@ -218,14 +327,20 @@ class AudioProcessor:
             dict: 性能统计
         """
         conversion_stats = self.audio_converter.get_conversion_stats()
-        avg_processing_time = (
-            self.total_processing_time / self.request_count 
-            if self.request_count > 0 else 0
-        )
         
         return {
             "total_requests": self.request_count,
             "total_processing_time": round(self.total_processing_time, 2),
-            "average_processing_time": round(avg_processing_time, 2),
+            "average_processing_time": round(self.get_average_processing_time(), 2),
             "conversion_stats": conversion_stats
-        } 
\ No newline at end of file
+        }
+    
+    def _record_processing_time(self, total_time: float) -> None:
+        """记录一次请求的处理耗时"""
+        self.total_processing_time += total_time
+        self._recent_processing_times.append(total_time)
+    
+    def get_average_processing_time(self) -> float:
+        """计算最近请求的平均处理时间（秒）"""
+        recent = list(self._recent_processing_times)
+        return sum(recent) / len(recent) if recent else 0.0 
\ No newline at end of file
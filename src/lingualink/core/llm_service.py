@@ -1,122 +1,161 @@
-import base64
+import asyncio
+import mmap
+import pybase64
 import os
 import time
-import copy
+import functools
 import json
 import re
-from typing import Dict, Any, List, Optional
-from openai import OpenAI
+from typing import Dict, Any, List, Optional, Tuple
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from config.settings import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 模型输出中以"键：值"开头的行（兼容中英文冒号，键不能为空）
+_KEY_LINE_RE = re.compile(r'^[^\S\n]*([^\n:：]*[^\s:：][^\n:：]*)[:：]', re.MULTILINE)
+
+# 错误详情中附带的后端响应体最大字符数
+ERROR_BODY_MAX_CHARS = 1024
+
+# 系统提示词中与目标语言无关的固定部分
+_PROMPT_HEADER = "你是一个高级的语音处理助手。你的任务是：\n1.首先将音频内容转录成其原始语言的文本。\n"
+_PROMPT_FORMAT_HEADER = "请按照以下格式清晰地组织你的输出：\n原文："
+
+
+@functools.lru_cache(maxsize=64)
+def _build_system_prompt(target_languages: Tuple[str, ...]) -> str:
+    """根据目标语言构建系统提示词；实际使用中的语言组合很少，结果按组合缓存"""
+    tasks = "".join(f"{i+2}. 将转录的文本翻译成{lang}。\n" for i, lang in enumerate(target_languages))
+    output_format = "".join(f"\n{lang}：" for lang in target_languages)
+    return f"{_PROMPT_HEADER}{tasks}{_PROMPT_FORMAT_HEADER}{output_format}"
+
+
+def encode_audio_to_base64(audio_path: str) -> tuple[str, str]:
+    """将音频文件编码为base64字符串"""
+    # 先做不涉及文件系统的扩展名检查；文件是否存在由open判断，省去一次单独的stat
+    if not audio_path.lower().endswith(".wav"):
+        raise ValueError(f"Unsupported audio format: {audio_path}. Only .wav files are supported.")
+
+    audio_format = "wav"
+    
+    # 文件内容只通过mmap访问，不需要Python层的读缓冲
+    try:
+        audio_file = open(audio_path, "rb", buffering=0)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Audio file not found: {audio_path}") from None
+    
+    with audio_file:
+        if os.fstat(audio_file.fileno()).st_size == 0:
+            return "", audio_format
+        # 直接对内存映射编码，省去读入bytes的完整拷贝；pybase64使用SIMD编码并直接生成str
+        with mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ) as audio_data:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                # 编码器顺序扫描整个文件，提示内核加大预读并及时回收已读页
+                audio_data.madvise(mmap.MADV_SEQUENTIAL)
+            base64_string = pybase64.b64encode_as_string(audio_data)
+    
+    return base64_string, audio_format
+
+
+def _log_payload(model_name: str, messages: List[Dict[str, Any]]) -> None:
+    """以DEBUG级别记录请求内容，音频数据截断；只复制包含音频的条目，不深拷贝整个消息"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    
+    display_messages = []
+    for msg in messages:
+        if msg["role"] == "user" and isinstance(msg["content"], list):
+            display_content = []
+            for item in msg["content"]:
+                if item.get("type") == "input_audio" and len(item["input_audio"]["data"]) > 100:
+                    truncated_audio = {**item["input_audio"], "data": item["input_audio"]["data"][:100] + "...[TRUNCATED]"}
+                    item = {**item, "input_audio": truncated_audio}
+                display_content.append(item)
+            msg = {**msg, "content": display_content}
+        display_messages.append(msg)
+    
+    payload_to_display = {
+        "model": model_name,
+        "messages": display_messages,
+        "max_tokens": 200,
+        "temperature": 0
+    }
+    logger.debug("Payload (audio data truncated): %s", json.dumps(payload_to_display, indent=2))
+
+
+def _parse_model_response(content: str) -> Dict[str, Any]:
+    """解析模型响应内容"""
+    parsed_output = {"raw_text": content}
+    
+    try:
+        # 一次扫描找出所有键所在的行，两个键之间的内容即为前一个键的值（保留空行）
+        text = content.strip()
+        key_matches = list(_KEY_LINE_RE.finditer(text))
+        for i, match in enumerate(key_matches):
+            value_end = key_matches[i + 1].start() - 1 if i + 1 < len(key_matches) else len(text)
+            value_lines = text[match.end():value_end].split('\n')
+            parsed_output[match.group(1).strip()] = "\n".join(line.strip() for line in value_lines)
+    
+    except Exception as parse_error:
+        logger.warning(f"Could not fully parse model output: {parse_error}")
+
+    return parsed_output
+
 
 class LLMService:
     """LLM服务类，处理与语言模型的交互"""
     
     def __init__(self):
         self.client = self._create_client()
+        # 请求地址只在创建客户端时计算一次，供请求日志使用
+        self._chat_completions_url = f"{self.client.base_url}chat/completions"
+        # 限制同时进行的LLM请求数，超出的请求在事件循环中等待，不占用线程
+        self._request_semaphore = asyncio.Semaphore(settings.max_concurrent_llm_requests)
     
-    def _create_client(self) -> OpenAI:
-        """创建OpenAI客户端"""
+    def _create_client(self) -> AsyncOpenAI:
+        """创建异步OpenAI客户端（底层httpx连接池在请求间复用）"""
         temp_vllm_server_url = settings.vllm_server_url.rstrip('/')
         if temp_vllm_server_url.endswith('/v1'):
             final_base_url = temp_vllm_server_url
         else:
             final_base_url = f"{temp_vllm_server_url}/v1"
         
-        return OpenAI(
+        return AsyncOpenAI(
             api_key=settings.api_key,
-            base_url=final_base_url
+            base_url=final_base_url,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings.max_concurrent_llm_requests,
+                    max_keepalive_connections=settings.max_concurrent_llm_requests
+                )
+            )
         )
     
-    def encode_audio_to_base64(self, audio_path: str) -> tuple[str, str]:
-        """将音频文件编码为base64字符串"""
-        if not os.path.exists(audio_path):
-            raise FileNotFoundError(f"Audio file not found: {audio_path}")
-
-        if not audio_path.lower().endswith(".wav"):
-            raise ValueError(f"Unsupported audio format: {audio_path}. Only .wav files are supported.")
-
-        audio_format = "wav"
-        
-        with open(audio_path, "rb") as audio_file:
-            binary_data = audio_file.read()
-            base64_encoded_data = base64.b64encode(binary_data)
-            base64_string = base64_encoded_data.decode('utf-8')
-        
-        return base64_string, audio_format
+    async def close(self) -> None:
+        """关闭客户端连接池"""
+        await self.client.close()
+    
+    # 与负载均衡版本共用的模块级实现
+    encode_audio_to_base64 = staticmethod(encode_audio_to_base64)
+    _log_payload = staticmethod(_log_payload)
+    _parse_model_response = staticmethod(_parse_model_response)
     
     def generate_system_prompt(self, target_languages: Optional[List[str]] = None) -> str:
-        """生成系统提示词"""
+        """生成系统提示词（按目标语言组合缓存）"""
         if target_languages is None:
             target_languages = settings.default_target_languages
-
-        prompt_lines = [
-            "你是一个高级的语音处理助手。你的任务是：",
-            "1.首先将音频内容转录成其原始语言的文本。"
-        ]
-
-        for i, lang in enumerate(target_languages):
-            prompt_lines.append(f"{i+2}. 将转录的文本翻译成{lang}。")
         
-        prompt_lines.append("请按照以下格式清晰地组织你的输出：")
-        prompt_lines.append("原文：")
-        for lang in target_languages:
-            prompt_lines.append(f"{lang}：")
-            
-        return "\n".join(prompt_lines)
+        return _build_system_prompt(tuple(target_languages))
     
-    def _parse_model_response(self, content: str) -> Dict[str, Any]:
-        """解析模型响应内容"""
-        parsed_output = {"raw_text": content}
-        current_key = None
-        current_value_lines = []
-        
-        try:
-            lines = content.strip().split('\n')
-            for line_content in lines:
-                stripped_content = line_content.strip()
-
-                if not stripped_content:
-                    if current_key:
-                        current_value_lines.append("")  # 保留空行
-                    continue
-
-                parts = re.split(r'[:：]', stripped_content, maxsplit=1)
-
-                if len(parts) == 2:  # 可能的新键
-                    new_key_candidate = parts[0].strip()
-                    new_value_first_line = parts[1].strip()
-
-                    if new_key_candidate:  # 有效的新键
-                        if current_key:  # 保存前一个键的内容
-                            parsed_output[current_key] = "\n".join(current_value_lines)
-                        
-                        current_key = new_key_candidate
-                        current_value_lines = [new_value_first_line]
-                    elif current_key:  # 键部分为空，作为延续处理
-                        current_value_lines.append(stripped_content)
-
-                elif current_key:  # 没有冒号，有活跃键，追加内容
-                    current_value_lines.append(stripped_content)
-
-            # 保存最后一个键
-            if current_key:
-                parsed_output[current_key] = "\n".join(current_value_lines)
-        
-        except Exception as parse_error:
-            logger.warning(f"Could not fully parse model output: {parse_error}")
-
-        return parsed_output
-    
-    def process_audio(self, audio_path: str, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+    async def process_audio(self, audio_path: str, system_prompt: str, user_prompt: str) -> Dict[str, Any]:
         """处理音频文件，返回结构化响应"""
         try:
-            # 编码音频
-            base64_encoded_audio, audio_format = self.encode_audio_to_base64(audio_path)
-            logger.info(f"Successfully encoded audio file: {audio_path} (Format: {audio_format})")
+            # 编码音频（读取文件和编码在线程中执行）
+            base64_encoded_audio, audio_format = await asyncio.to_thread(self.encode_audio_to_base64, audio_path)
+            logger.info("Successfully encoded audio file: %s (Format: %s)", audio_path, audio_format)
         except Exception as e:
             logger.error(f"Error encoding audio: {e}")
             return {
@@ -144,34 +183,20 @@ class LLMService:
             })
             messages.append({"role": "user", "content": user_content})
             
-            # 记录请求（截断音频数据）
-            payload_to_display = {
-                "model": settings.model_name,
-                "messages": copy.deepcopy(messages),
-                "max_tokens": 200,
-                "temperature": 0
-            }
-            for msg_log in payload_to_display["messages"]:
-                if msg_log["role"] == "user" and isinstance(msg_log["content"], list):
-                    for content_item_log in msg_log["content"]:
-                        if content_item_log.get("type") == "input_audio":
-                            data_to_log = content_item_log["input_audio"]["data"]
-                            if len(data_to_log) > 100:
-                                content_item_log["input_audio"]["data"] = data_to_log[:100] + "...[TRUNCATED]"
-            
-            logger.info(f"Sending request to: {self.client.base_url}chat/completions")
-            logger.debug(f"Payload (audio data truncated): {json.dumps(payload_to_display, indent=2)}")
+            logger.info("Sending request to: %s", self._chat_completions_url)
+            self._log_payload(settings.model_name, messages)
 
             # 发送请求
-            start_time = time.monotonic()
-            chat_completion = self.client.chat.completions.create(
-                model=settings.model_name,
-                messages=messages,
-                max_tokens=200,
-                temperature=0 
-            )
+            async with self._request_semaphore:
+                start_time = time.monotonic()
+                chat_completion = await self.client.chat.completions.create(
+                    model=settings.model_name,
+                    messages=messages,
+                    max_tokens=200,
+                    temperature=0 
+                )
             duration = time.monotonic() - start_time
-            logger.info(f"API call completed in {duration:.2f} seconds.")
+            logger.info("API call completed in %.2f seconds.", duration)
 
             # 处理响应
             if chat_completion.choices and len(chat_completion.choices) > 0:
@@ -199,10 +224,9 @@ class LLMService:
             response_details = None
             if hasattr(e, 'response') and e.response is not None:
                 response_details = {"status_code": e.response.status_code}
-                try:
-                    response_details["content"] = e.response.json()
-                except ValueError:
-                    response_details["content"] = e.response.text
+                # 客户端只依赖状态码；错误响应体仅在DEBUG级别下截断附带，不做JSON解析
+                if logger.isEnabledFor(logging.DEBUG):
+                    response_details["content"] = e.response.text[:ERROR_BODY_MAX_CHARS]
             
             return {
                 "status": "error", 
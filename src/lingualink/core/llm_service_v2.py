@@ -1,14 +1,11 @@
-import base64
-import os
 import time
-import copy
-import json
-import re
 import asyncio
 from typing import Dict, Any, List, Optional
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from config.settings import settings
 import logging
+from .llm_service import _build_system_prompt, _log_payload, _parse_model_response, encode_audio_to_base64
 from .load_balancer import (
     LLMLoadBalancer, BackendConfig, LoadBalanceStrategy,
     BackendStatus
@@ -22,7 +19,17 @@ class LoadBalancedLLMService:
     
     def __init__(self):
         self.load_balancer: Optional[LLMLoadBalancer] = None
-        self._clients: Dict[str, OpenAI] = {}
+        # 所有后端共用一个httpx连接池（按主机分别保持连接），每个后端的并发上限由下面的信号量控制
+        self._http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        )
+        self._clients: Dict[str, AsyncOpenAI] = {}
+        # 每个后端的并发上限（max_connections），超出的请求在事件循环中排队等待，而不是在连接池中超时
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        # 每个后端的chat/completions地址，创建客户端时计算一次，供请求日志使用
+        self._chat_completions_urls: Dict[str, str] = {}
+        # 单后端模式下使用的后端配置，与负载均衡模式共用同一请求路径
+        self._default_backend: Optional[BackendConfig] = None
         self._initialize_load_balancer()
     
     def _initialize_load_balancer(self):
@@ -32,7 +39,15 @@ class LoadBalancedLLMService:
             logger.info("负载均衡未启用，使用传统单后端模式")
             self.load_balancer = None
             # 创建单个客户端
-            self._clients["default"] = self._create_single_client()
+            self._default_backend = BackendConfig(
+                name="default",
+                url=settings.vllm_server_url,
+                model_name=settings.model_name,
+                api_key=settings.api_key,
+                max_connections=settings.max_concurrent_llm_requests,
+                timeout=30.0
+            )
+            self._register_backend(self._default_backend)
             return
         
         backends = self._parse_backend_configs()
@@ -56,12 +71,14 @@ class LoadBalancedLLMService:
             strategy=strategy,
             health_check_interval=getattr(settings, 'health_check_interval', 30.0),
             max_retries=getattr(settings, 'max_retries', 2),
-            failure_threshold=getattr(settings, 'failure_threshold', 3)
+            failure_threshold=getattr(settings, 'failure_threshold', 3),
+            vnodes_per_weight=getattr(settings, 'hash_ring_vnodes_per_weight', 40),
+            health_check_concurrency=getattr(settings, 'health_check_concurrency', 16)
         )
         
         # 为每个后端创建客户端
         for backend in backends:
-            self._clients[backend.name] = self._create_client(backend)
+            self._register_backend(backend)
         
         logger.info(f"负载均衡LLM服务初始化完成，包含 {len(backends)} 个后端")
     
@@ -88,32 +105,26 @@ class LoadBalancedLLMService:
         
         return backends
     
-    def _create_client(self, backend: BackendConfig) -> OpenAI:
-        """为指定后端创建OpenAI客户端"""
+    def _register_backend(self, backend: BackendConfig) -> None:
+        """为后端创建客户端、并发信号量和请求地址"""
+        client = self._create_client(backend)
+        self._clients[backend.name] = client
+        self._semaphores[backend.name] = asyncio.Semaphore(backend.max_connections)
+        self._chat_completions_urls[backend.name] = f"{client.base_url}chat/completions"
+    
+    def _create_client(self, backend: BackendConfig) -> AsyncOpenAI:
+        """为指定后端创建异步OpenAI客户端，底层使用共享的httpx连接池"""
         temp_url = backend.url.rstrip('/')
         if temp_url.endswith('/v1'):
             final_base_url = temp_url
         else:
             final_base_url = f"{temp_url}/v1"
         
-        return OpenAI(
+        return AsyncOpenAI(
             api_key=backend.api_key,
             base_url=final_base_url,
-            timeout=backend.timeout
-        )
-    
-    def _create_single_client(self) -> OpenAI:
-        """为单后端模式创建OpenAI客户端"""
-        temp_url = settings.vllm_server_url.rstrip('/')
-        if temp_url.endswith('/v1'):
-            final_base_url = temp_url
-        else:
-            final_base_url = f"{temp_url}/v1"
-        
-        return OpenAI(
-            api_key=settings.api_key,
-            base_url=final_base_url,
-            timeout=30.0
+            timeout=backend.timeout,
+            http_client=self._http_client
         )
     
     async def start_health_check(self):
@@ -126,94 +137,32 @@ class LoadBalancedLLMService:
         if self.load_balancer:
             await self.load_balancer.stop_health_check()
     
-    def encode_audio_to_base64(self, audio_path: str) -> tuple[str, str]:
-        """将音频文件编码为base64字符串"""
-        if not os.path.exists(audio_path):
-            raise FileNotFoundError(f"Audio file not found: {audio_path}")
-
-        if not audio_path.lower().endswith(".wav"):
-            raise ValueError(f"Unsupported audio format: {audio_path}. Only .wav files are supported.")
-
-        audio_format = "wav"
-        
-        with open(audio_path, "rb") as audio_file:
-            binary_data = audio_file.read()
-            base64_encoded_data = base64.b64encode(binary_data)
-            base64_string = base64_encoded_data.decode('utf-8')
-        
-        return base64_string, audio_format
+    async def close(self) -> None:
+        """停止健康检查并关闭共享连接池"""
+        await self.stop_health_check()
+        self._clients.clear()
+        await self._http_client.aclose()
+    
+    # 与单后端版本共用的模块级实现
+    encode_audio_to_base64 = staticmethod(encode_audio_to_base64)
+    _log_payload = staticmethod(_log_payload)
+    _parse_model_response = staticmethod(_parse_model_response)
     
     def generate_system_prompt(self, target_languages: Optional[List[str]] = None) -> str:
-        """生成系统提示词"""
+        """生成系统提示词（按目标语言组合缓存）"""
         if target_languages is None:
             target_languages = settings.default_target_languages
-
-        prompt_lines = [
-            "你是一个高级的语音处理助手。你的任务是：",
-            "1.首先将音频内容转录成其原始语言的文本。"
-        ]
-
-        for i, lang in enumerate(target_languages):
-            prompt_lines.append(f"{i+2}. 将转录的文本翻译成{lang}。")
         
-        prompt_lines.append("请按照以下格式清晰地组织你的输出：")
-        prompt_lines.append("原文：")
-        for lang in target_languages:
-            prompt_lines.append(f"{lang}：")
-            
-        return "\n".join(prompt_lines)
+        return _build_system_prompt(tuple(target_languages))
     
-    def _parse_model_response(self, content: str) -> Dict[str, Any]:
-        """解析模型响应内容"""
-        parsed_output = {"raw_text": content}
-        current_key = None
-        current_value_lines = []
-        
-        try:
-            lines = content.strip().split('\n')
-            for line_content in lines:
-                stripped_content = line_content.strip()
-
-                if not stripped_content:
-                    if current_key:
-                        current_value_lines.append("")  # 保留空行
-                    continue
-
-                parts = re.split(r'[:：]', stripped_content, maxsplit=1)
-
-                if len(parts) == 2:  # 可能的新键
-                    new_key_candidate = parts[0].strip()
-                    new_value_first_line = parts[1].strip()
-
-                    if new_key_candidate:  # 有效的新键
-                        if current_key:  # 保存前一个键的内容
-                            parsed_output[current_key] = "\n".join(current_value_lines)
-                        
-                        current_key = new_key_candidate
-                        current_value_lines = [new_value_first_line]
-                    elif current_key:  # 键部分为空，作为延续处理
-                        current_value_lines.append(stripped_content)
-
-                elif current_key:  # 没有冒号，有活跃键，追加内容
-                    current_value_lines.append(stripped_content)
-
-            # 保存最后一个键
-            if current_key:
-                parsed_output[current_key] = "\n".join(current_value_lines)
-        
-        except Exception as parse_error:
-            logger.warning(f"Could not fully parse model output: {parse_error}")
-
-        return parsed_output
-    
-    def process_audio(self, audio_path: str, system_prompt: str, user_prompt: str,
-                     request_hash: Optional[str] = None) -> Dict[str, Any]:
+    async def process_audio(self, audio_path: str, system_prompt: str, user_prompt: str,
+                           request_hash: Optional[str] = None) -> Dict[str, Any]:
         """处理音频文件，使用负载均衡或单后端"""
         
-        # 编码音频
+        # 编码音频（读文件和编码在线程中执行，避免阻塞事件循环）
         try:
-            base64_encoded_audio, audio_format = self.encode_audio_to_base64(audio_path)
-            logger.info(f"Successfully encoded audio file: {audio_path} (Format: {audio_format})")
+            base64_encoded_audio, audio_format = await asyncio.to_thread(self.encode_audio_to_base64, audio_path)
+            logger.info("Successfully encoded audio file: %s (Format: %s)", audio_path, audio_format)
         except Exception as e:
             logger.error(f"Error encoding audio: {e}")
             return {
@@ -224,69 +173,66 @@ class LoadBalancedLLMService:
         
         # 如果没有启用负载均衡，使用传统单后端模式
         if not self.load_balancer:
-            return self._process_single_backend(
+            return await self._process_default_backend(
                 base64_encoded_audio, audio_format, system_prompt, user_prompt
             )
         
         # 负载均衡模式：尝试多个后端
-        max_retries = self.load_balancer.max_retries if self.load_balancer else 1
+        max_retries = self.load_balancer.max_retries
         
         for attempt in range(max_retries + 1):
-            # 选择后端
-            backend_name = self.load_balancer.select_backend(request_hash) if self.load_balancer else "default"
-            
-            if not backend_name:
-                return {
-                    "status": "error",
-                    "message": "没有可用的后端服务器",
-                    "details": None
-                }
-            
-            backend_config = self.load_balancer.get_backend_config(backend_name)
-            client = self._clients.get(backend_name)
-            
-            if not client or not backend_config:
-                logger.error(f"后端 {backend_name} 的客户端或配置不存在")
-                continue
-            
-            try:
-                result = self._make_request(
-                    client=client,
-                    backend_config=backend_config,
-                    base64_encoded_audio=base64_encoded_audio,
-                    audio_format=audio_format,
-                    system_prompt=system_prompt,
-                    user_prompt=user_prompt
-                )
+            # 选择后端并占用连接计数，无论成功、失败还是请求被取消，退出时都只释放一次；
+            # 重试时不再带请求哈希，避免一致性哈希反复选中刚刚失败的后端
+            with self.load_balancer.acquire_backend(request_hash if attempt == 0 else None) as backend_name:
+                if not backend_name:
+                    return {
+                        "status": "error",
+                        "message": "没有可用的后端服务器",
+                        "details": None
+                    }
+                
+                backend_config = self.load_balancer.get_backend_config(backend_name)
+                client = self._clients.get(backend_name)
                 
-                # 记录成功
-                if self.load_balancer:
+                if not client or not backend_config:
+                    logger.error(f"后端 {backend_name} 的客户端或配置不存在")
+                    continue
+                
+                try:
+                    async with self._semaphores[backend_name]:
+                        result = await self._make_request(
+                            client=client,
+                            backend_config=backend_config,
+                            base64_encoded_audio=base64_encoded_audio,
+                            audio_format=audio_format,
+                            system_prompt=system_prompt,
+                            user_prompt=user_prompt
+                        )
+                    
+                    # 记录成功
                     self.load_balancer.record_request_result(
                         backend_name, True, result.get("duration_seconds", 0)
                     )
-                    self.load_balancer.release_connection(backend_name)
-                
-                # 添加后端信息到结果中
-                result["backend"] = backend_name
-                return result
-                
-            except Exception as e:
-                logger.warning(f"后端 {backend_name} 请求失败 (尝试 {attempt + 1}/{max_retries + 1}): {e}")
-                
-                # 记录失败
-                if self.load_balancer:
+                    
+                    # 添加后端信息到结果中
+                    result["backend"] = backend_name
+                    return result
+                    
+                except Exception as e:
+                    logger.warning(f"后端 {backend_name} 请求失败 (尝试 {attempt + 1}/{max_retries + 1}): {e}")
+                    
+                    # 记录失败
                     self.load_balancer.record_request_result(
                         backend_name, False, 0, str(e)
                     )
-                    self.load_balancer.release_connection(backend_name)
-                
-                # 如果是最后一次尝试，返回错误
-                if attempt == max_retries:
-                    return {
-                        "status": "error",
-                        "message": f"所有后端都请求失败，最后错误: {e}",
-                        "details": {"backend": backend_name, "error": str(e)}
-                    }
+                    
+                    # 如果是最后一次尝试，返回错误
+                    if attempt == max_retries:
+                        return {
+                            "status": "error",
+                            "message": f"所有后端都请求失败，最后错误: {e}",
+                            "details": {"backend": backend_name, "error": str(e)}
+                        }
         
         return {
             "status": "error",
@@ -294,9 +240,9 @@ class LoadBalancedLLMService:
             "details": None
         }
     
-    def _make_request(self, client: OpenAI, backend_config: BackendConfig,
-                     base64_encoded_audio: str, audio_format: str,
-                     system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+    async def _make_request(self, client: AsyncOpenAI, backend_config: BackendConfig,
+                            base64_encoded_audio: str, audio_format: str,
+                            system_prompt: str, user_prompt: str) -> Dict[str, Any]:
         """向指定后端发送请求"""
         
         # 构建消息
@@ -317,34 +263,19 @@ class LoadBalancedLLMService:
         })
         messages.append({"role": "user", "content": user_content})
         
-        # 记录请求（截断音频数据）
-        payload_to_display = {
-            "model": backend_config.model_name,
-            "messages": copy.deepcopy(messages),
-            "max_tokens": 200,
-            "temperature": 0
-        }
-        for msg_log in payload_to_display["messages"]:
-            if msg_log["role"] == "user" and isinstance(msg_log["content"], list):
-                for content_item_log in msg_log["content"]:
-                    if content_item_log.get("type") == "input_audio":
-                        data_to_log = content_item_log["input_audio"]["data"]
-                        if len(data_to_log) > 100:
-                            content_item_log["input_audio"]["data"] = data_to_log[:100] + "...[TRUNCATED]"
-        
-        logger.info(f"Sending request to: {client.base_url}chat/completions")
-        logger.debug(f"Payload (audio data truncated): {json.dumps(payload_to_display, indent=2)}")
+        logger.info("Sending request to: %s", self._chat_completions_urls.get(backend_config.name))
+        self._log_payload(backend_config.model_name, messages)
 
         # 发送请求
         start_time = time.monotonic()
-        chat_completion = client.chat.completions.create(
+        chat_completion = await client.chat.completions.create(
             model=backend_config.model_name,
             messages=messages,
             max_tokens=200,
             temperature=0 
         )
         duration = time.monotonic() - start_time
-        logger.info(f"API call completed in {duration:.2f} seconds.")
+        logger.info("API call completed in %.2f seconds.", duration)
 
         # 处理响应
         if chat_completion.choices and len(chat_completion.choices) > 0:
@@ -360,11 +291,11 @@ class LoadBalancedLLMService:
             logger.error(f"No valid choice found in response: {chat_completion}")
             raise Exception("No valid choice in model response")
     
-    def _process_single_backend(self, base64_encoded_audio: str, audio_format: str,
-                               system_prompt: str, user_prompt: str) -> Dict[str, Any]:
+    async def _process_default_backend(self, base64_encoded_audio: str, audio_format: str,
+                                       system_prompt: str, user_prompt: str) -> Dict[str, Any]:
         """传统单后端处理模式"""
         client = self._clients.get("default")
-        if not client:
+        if not client or not self._default_backend:
             return {
                 "status": "error",
                 "message": "单后端客户端未初始化",
@@ -372,71 +303,15 @@ class LoadBalancedLLMService:
             }
         
         try:
-            # 构建消息
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-
-            user_content = []
-            if user_prompt:
-                user_content.append({"type": "text", "text": user_prompt})
-
-            user_content.append({
-                "type": "input_audio",
-                "input_audio": {
-                    "data": base64_encoded_audio,
-                    "format": audio_format
-                },
-            })
-            messages.append({"role": "user", "content": user_content})
-            
-            # 记录请求（截断音频数据）
-            payload_to_display = {
-                "model": settings.model_name,
-                "messages": copy.deepcopy(messages),
-                "max_tokens": 200,
-                "temperature": 0
-            }
-            for msg_log in payload_to_display["messages"]:
-                if msg_log["role"] == "user" and isinstance(msg_log["content"], list):
-                    for content_item_log in msg_log["content"]:
-                        if content_item_log.get("type") == "input_audio":
-                            data_to_log = content_item_log["input_audio"]["data"]
-                            if len(data_to_log) > 100:
-                                content_item_log["input_audio"]["data"] = data_to_log[:100] + "...[TRUNCATED]"
-            
-            logger.info(f"Sending request to: {client.base_url}chat/completions")
-            logger.debug(f"Payload (audio data truncated): {json.dumps(payload_to_display, indent=2)}")
-
-            # 发送请求
-            start_time = time.monotonic()
-            chat_completion = client.chat.completions.create(
-                model=settings.model_name,
-                messages=messages,
-                max_tokens=200,
-                temperature=0 
-            )
-            duration = time.monotonic() - start_time
-            logger.info(f"API call completed in {duration:.2f} seconds.")
-
-            # 处理响应
-            if chat_completion.choices and len(chat_completion.choices) > 0:
-                message_content = chat_completion.choices[0].message.content
-                parsed_output = self._parse_model_response(message_content)
-
-                return {
-                    "status": "success",
-                    "duration_seconds": duration,
-                    "data": parsed_output,
-                    "backend": "default"
-                }
-            else:
-                logger.error(f"No valid choice found in response: {chat_completion}")
-                return {
-                    "status": "error",
-                    "message": "No valid choice in model response",
-                    "details": str(chat_completion)
-                }
+            async with self._semaphores["default"]:
+                result = await self._make_request(
+                    client=client,
+                    backend_config=self._default_backend,
+                    base64_encoded_audio=base64_encoded_audio,
+                    audio_format=audio_format,
+                    system_prompt=system_prompt,
+                    user_prompt=user_prompt
+                )
         except Exception as e:
             logger.error(f"单后端API调用失败: {e}", exc_info=True)
             return {
@@ -444,6 +319,9 @@ class LoadBalancedLLMService:
                 "message": f"API调用失败: {e}",
                 "details": None
             }
+        
+        result["backend"] = "default"
+        return result
     
     def get_load_balancer_metrics(self) -> Dict[str, Any]:
         """获取负载均衡器指标"""
@@ -475,20 +353,21 @@ class LoadBalancedLLMService:
         )
         
         self.load_balancer.add_backend(backend)
-        self._clients[name] = self._create_client(backend)
+        self._register_backend(backend)
         
         logger.info(f"动态添加后端: {name}")
         return True
     
     def remove_backend(self, backend_name: str):
-        """动态移除后端"""
+        """动态移除后端（该后端的空闲连接由共享连接池按keepalive过期回收）"""
         if not self.load_balancer:
             logger.error("负载均衡器未初始化")
             return False
         
         self.load_balancer.remove_backend(backend_name)
-        if backend_name in self._clients:
-            del self._clients[backend_name]
+        self._semaphores.pop(backend_name, None)
+        self._chat_completions_urls.pop(backend_name, None)
+        self._clients.pop(backend_name, None)
         
         logger.info(f"动态移除后端: {backend_name}")
         return True
@@ -1,19 +1,23 @@
 import asyncio
+import bisect
 import time
 import random
 import hashlib
-from typing import Dict, List, Optional, Any, Tuple
+import itertools
+from typing import Callable, Dict, Iterator, List, Optional, Any, Tuple
 from dataclasses import dataclass, field
 from enum import Enum
 import logging
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 import aiohttp
 from threading import Lock
-from collections import defaultdict
-import statistics
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
+# 每个后端保留的最近响应时间条数
+RESPONSE_TIME_WINDOW = 50
+
 
 class LoadBalanceStrategy(Enum):
     """负载均衡策略枚举"""
@@ -22,6 +26,7 @@ class LoadBalanceStrategy(Enum):
     LEAST_CONNECTIONS = "least_connections"  # 最少连接数
     RANDOM = "random"                     # 随机
     CONSISTENT_HASH = "consistent_hash"   # 一致性哈希
+    CONSISTENT_HASH_FAILOVER = "consistent_hash_failover"  # 一致性哈希，无哈希或后端不可用时回退轮询
     RESPONSE_TIME = "response_time"       # 响应时间最优
 
 
@@ -32,21 +37,30 @@ class BackendStatus(Enum):
     DISABLED = "disabled"
 
 
-@dataclass
+@dataclass(slots=True)
 class BackendConfig:
-    """后端配置"""
+    """后端配置（slots数据类只声明公开配置字段，派生值用属性计算）"""
     name: str
     url: str
     model_name: str
-    api_key: str
+    api_key: str = field(repr=False)  # 不出现在日志打印的repr中
     weight: int = 1
     max_connections: int = 50
     timeout: float = 30.0
     priority: int = 0  # 优先级，数值越小优先级越高
     tags: List[str] = field(default_factory=list)
+    
+    # 健康检查的URL和请求头按当前配置派生，不作为数据类字段（避免asdict泄露密钥、参与比较或过期）
+    @property
+    def health_url(self) -> str:
+        return f"{self.url.rstrip('/')}/v1/models"
+    
+    @property
+    def auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_key}"}
 
 
-@dataclass
+@dataclass(slots=True)
 class BackendMetrics:
     """后端性能指标"""
     total_requests: int = 0
@@ -54,20 +68,23 @@ class BackendMetrics:
     failed_requests: int = 0
     active_connections: int = 0
     average_response_time: float = 0.0
-    response_times: List[float] = field(default_factory=list)
+    response_times: deque = field(default_factory=lambda: deque(maxlen=RESPONSE_TIME_WINDOW))
     last_check_time: float = 0.0
     status: BackendStatus = BackendStatus.HEALTHY
     consecutive_failures: int = 0
     last_error: Optional[str] = None
+    _response_time_sum: float = field(default=0.0, repr=False)
+    # 仅保护本后端指标的锁，不同后端之间互不阻塞
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
     
     def update_response_time(self, response_time: float):
-        """更新响应时间统计"""
+        """更新响应时间统计，只保留最近RESPONSE_TIME_WINDOW次，均值按滑动窗口增量维护"""
+        if len(self.response_times) == self.response_times.maxlen:
+            self._response_time_sum -= self.response_times[0]
         self.response_times.append(response_time)
-        # 只保留最近50次的响应时间
-        if len(self.response_times) > 50:
-            self.response_times = self.response_times[-50:]
+        self._response_time_sum += response_time
         
-        self.average_response_time = statistics.mean(self.response_times)
+        self.average_response_time = self._response_time_sum / len(self.response_times)
     
     def get_success_rate(self) -> float:
         """获取成功率"""
@@ -84,41 +101,123 @@ class LLMLoadBalancer:
                  strategy: LoadBalanceStrategy = LoadBalanceStrategy.ROUND_ROBIN,
                  health_check_interval: float = 30.0,
                  max_retries: int = 2,
-                 failure_threshold: int = 3):
+                 failure_threshold: int = 3,
+                 vnodes_per_weight: int = 40,
+                 health_check_concurrency: int = 16):
         self.backends = {backend.name: backend for backend in backends}
         self.strategy = strategy
         self.health_check_interval = health_check_interval
         self.max_retries = max_retries
         self.failure_threshold = failure_threshold
+        # 一致性哈希每单位权重的虚拟节点数：越多分布越均匀，环越大（构建越慢、查找缓存命中越差）
+        self.vnodes_per_weight = max(1, vnodes_per_weight)
         
         # 性能指标
         self.metrics: Dict[str, BackendMetrics] = {}
         for backend in backends:
             self.metrics[backend.name] = BackendMetrics()
         
-        # 状态管理
+        # 状态管理：_lock只在增删后端时使用，各后端的计数由各自的metrics.lock保护
         self._lock = Lock()
-        self._round_robin_index = 0
+        # 轮询计数器：后端选择只在事件循环线程上调用，无需加锁（不依赖GIL的原子性）
+        self._rr_counter = itertools.count()
+        # 可用后端列表及其加权展开的缓存，后端状态或集合变化时失效
+        self._available_cache: Optional[List[str]] = None
+        self._weighted_cache: Optional[Tuple[List[str], List[str]]] = None
+        # 策略分发表，参数为(可用后端列表, 请求哈希)；strategy可在运行时修改，每次选择时查表
+        self._strategy_dispatch: Dict[LoadBalanceStrategy, Callable[[List[str], Optional[str]], Optional[str]]] = {
+            LoadBalanceStrategy.ROUND_ROBIN: lambda available, _: self._round_robin_select(available),
+            LoadBalanceStrategy.WEIGHTED_ROUND_ROBIN: lambda available, _: self._weighted_round_robin_select(available),
+            LoadBalanceStrategy.LEAST_CONNECTIONS: lambda available, _: self._least_connections_select(available),
+            LoadBalanceStrategy.RANDOM: lambda available, _: self._random_select(available),
+            LoadBalanceStrategy.CONSISTENT_HASH: lambda _, request_hash: self._consistent_hash_select(request_hash or "default"),
+            LoadBalanceStrategy.CONSISTENT_HASH_FAILOVER: self._consistent_hash_failover_select,
+            LoadBalanceStrategy.RESPONSE_TIME: lambda available, _: self._response_time_select(available),
+        }
         self._hash_ring: Dict[int, str] = {}
+        # 按哈希值排序的环节点（两个平行数组），查找时二分定位
+        self._ring_keys_sorted: Tuple[int, ...] = ()
+        self._ring_backends_sorted: Tuple[str, ...] = ()
         self._health_check_task: Optional[asyncio.Task] = None
+        # 健康检查共用的HTTP会话，复用到各后端的连接
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 同时进行的健康检查数上限，避免后端很多时瞬间打开大量连接
+        self._health_semaphore = asyncio.Semaphore(max(1, health_check_concurrency))
         
         # 初始化一致性哈希环
         self._build_hash_ring()
         
         logger.info(f"LLM负载均衡器初始化完成，包含 {len(backends)} 个后端")
     
+    @staticmethod
+    def _ring_hash(key: str) -> int:
+        """计算哈希环上的位置（8字节BLAKE2b摘要，分布均匀且比MD5更快）"""
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+    
     def _build_hash_ring(self):
         """构建一致性哈希环"""
         self._hash_ring.clear()
         for backend_name, backend in self.backends.items():
             # 为每个后端创建多个虚拟节点
-            for i in range(backend.weight * 10):
+            for i in range(backend.weight * self.vnodes_per_weight):
                 virtual_node = f"{backend_name}#{i}"
-                hash_value = int(hashlib.md5(virtual_node.encode()).hexdigest(), 16)
-                self._hash_ring[hash_value] = backend_name
+                self._hash_ring[self._ring_hash(virtual_node)] = backend_name
+        
+        self._ring_keys_sorted = tuple(sorted(self._hash_ring))
+        self._ring_backends_sorted = tuple(self._hash_ring[k] for k in self._ring_keys_sorted)
+    
+    def _add_backend_to_ring(self, backend: BackendConfig):
+        """把单个后端的虚拟节点插入哈希环，其他后端的节点不重新计算"""
+        keys = list(self._ring_keys_sorted)
+        names = list(self._ring_backends_sorted)
+        for i in range(backend.weight * self.vnodes_per_weight):
+            hash_value = self._ring_hash(f"{backend.name}#{i}")
+            index = bisect.bisect_left(keys, hash_value)
+            if index < len(keys) and keys[index] == hash_value:
+                names[index] = backend.name
+            else:
+                keys.insert(index, hash_value)
+                names.insert(index, backend.name)
+            self._hash_ring[hash_value] = backend.name
+        
+        self._ring_keys_sorted = tuple(keys)
+        self._ring_backends_sorted = tuple(names)
+    
+    def _remove_backend_from_ring(self, backend_name: str):
+        """从哈希环中删除单个后端的虚拟节点"""
+        backend = self.backends.get(backend_name)
+        if backend is None:
+            return
+        
+        keys = list(self._ring_keys_sorted)
+        names = list(self._ring_backends_sorted)
+        for i in range(backend.weight * self.vnodes_per_weight):
+            hash_value = self._ring_hash(f"{backend_name}#{i}")
+            index = bisect.bisect_left(keys, hash_value)
+            if index < len(keys) and keys[index] == hash_value and names[index] == backend_name:
+                del keys[index]
+                del names[index]
+                del self._hash_ring[hash_value]
+        
+        self._ring_keys_sorted = tuple(keys)
+        self._ring_backends_sorted = tuple(names)
+    
+    def _get_health_session(self) -> aiohttp.ClientSession:
+        """获取健康检查用的共享会话，不存在或已关闭时创建"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0,
+                    limit_per_host=8,
+                    keepalive_timeout=60,
+                    ttl_dns_cache=300
+                )
+            )
+        return self._session
     
     async def start_health_check(self):
         """启动健康检查任务"""
+        self._get_health_session()
         if self._health_check_task is None or self._health_check_task.done():
             self._health_check_task = asyncio.create_task(self._health_check_loop())
             logger.info("健康检查任务已启动")
@@ -132,6 +231,10 @@ class LLMLoadBalancer:
             except asyncio.CancelledError:
                 pass
             logger.info("健康检查任务已停止")
+        
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
     
     async def _health_check_loop(self):
         """健康检查循环"""
@@ -145,13 +248,16 @@ class LLMLoadBalancer:
                 logger.error(f"健康检查出错: {e}")
     
     async def _check_all_backends(self):
-        """检查所有后端的健康状态"""
-        tasks = []
-        for backend_name in self.backends:
-            task = asyncio.create_task(self._check_backend_health(backend_name))
-            tasks.append(task)
+        """并发检查所有后端的健康状态，总耗时约为最慢的一次探测"""
+        backend_names = list(self.backends)
+        results = await asyncio.gather(
+            *[self._check_backend_health(name) for name in backend_names],
+            return_exceptions=True
+        )
         
-        await asyncio.gather(*tasks, return_exceptions=True)
+        for backend_name, result in zip(backend_names, results):
+            if isinstance(result, Exception):
+                logger.error(f"后端 {backend_name} 健康检查异常: {result}")
     
     async def _check_backend_health(self, backend_name: str):
         """检查单个后端的健康状态"""
@@ -159,116 +265,133 @@ class LLMLoadBalancer:
         metrics = self.metrics[backend_name]
         
         try:
-            start_time = time.time()
-            async with aiohttp.ClientSession() as session:
+            async with self._health_semaphore:
+                start_time = time.monotonic()
+                session = self._get_health_session()
                 # 发送健康检查请求
-                health_url = f"{backend.url.rstrip('/')}/v1/models"
                 async with session.get(
-                    health_url,
-                    headers={"Authorization": f"Bearer {backend.api_key}"},
+                    backend.health_url,
+                    headers=backend.auth_headers,
                     timeout=aiohttp.ClientTimeout(total=10)
                 ) as response:
-                    response_time = time.time() - start_time
-                    
-                    if response.status == 200:
-                        with self._lock:
-                            metrics.status = BackendStatus.HEALTHY
-                            metrics.consecutive_failures = 0
-                            metrics.last_check_time = time.time()
-                            metrics.update_response_time(response_time)
-                        logger.debug(f"后端 {backend_name} 健康检查通过")
-                    else:
-                        raise Exception(f"HTTP {response.status}")
+                    response_time = time.monotonic() - start_time
+                    status = response.status
+            
+            if status == 200:
+                with metrics.lock:
+                    if metrics.status != BackendStatus.HEALTHY:
+                        metrics.status = BackendStatus.HEALTHY
+                        self._invalidate_available_cache()
+                    metrics.consecutive_failures = 0
+                    metrics.last_check_time = time.time()
+                    metrics.update_response_time(response_time)
+                logger.debug(f"后端 {backend_name} 健康检查通过")
+            else:
+                raise Exception(f"HTTP {status}")
         
         except Exception as e:
-            with self._lock:
+            with metrics.lock:
                 metrics.consecutive_failures += 1
                 metrics.last_error = str(e)
                 metrics.last_check_time = time.time()
                 
                 if metrics.consecutive_failures >= self.failure_threshold:
-                    metrics.status = BackendStatus.UNHEALTHY
+                    if metrics.status != BackendStatus.UNHEALTHY:
+                        metrics.status = BackendStatus.UNHEALTHY
+                        self._invalidate_available_cache()
                     logger.warning(f"后端 {backend_name} 标记为不健康: {e}")
     
+    def _invalidate_available_cache(self):
+        """后端状态或集合变化后清除可用后端缓存"""
+        self._available_cache = None
+        self._weighted_cache = None
+    
     def _get_available_backends(self) -> List[str]:
-        """获取可用的后端列表"""
-        available = []
-        for backend_name, metrics in self.metrics.items():
-            if metrics.status == BackendStatus.HEALTHY:
-                available.append(backend_name)
+        """获取可用的后端列表（缓存的列表，调用方不可修改）"""
+        available = self._available_cache
+        if available is None:
+            available = [
+                backend_name for backend_name, metrics in self.metrics.items()
+                if metrics.status == BackendStatus.HEALTHY
+            ]
+            self._available_cache = available
         return available
     
     def select_backend(self, request_hash: Optional[str] = None) -> Optional[str]:
-        """根据策略选择后端"""
+        """根据策略选择后端，并增加其连接计数（调用方需调用release_connection释放）"""
+        # 选择过程不加全局锁：状态读取是原子的，连接计数只锁选中的后端
         available_backends = self._get_available_backends()
         
         if not available_backends:
             logger.error("没有可用的后端")
             return None
         
-        with self._lock:
-            if self.strategy == LoadBalanceStrategy.ROUND_ROBIN:
-                backend = self._round_robin_select(available_backends)
-            elif self.strategy == LoadBalanceStrategy.WEIGHTED_ROUND_ROBIN:
-                backend = self._weighted_round_robin_select(available_backends)
-            elif self.strategy == LoadBalanceStrategy.LEAST_CONNECTIONS:
-                backend = self._least_connections_select(available_backends)
-            elif self.strategy == LoadBalanceStrategy.RANDOM:
-                backend = self._random_select(available_backends)
-            elif self.strategy == LoadBalanceStrategy.CONSISTENT_HASH:
-                backend = self._consistent_hash_select(request_hash or "default")
-            elif self.strategy == LoadBalanceStrategy.RESPONSE_TIME:
-                backend = self._response_time_select(available_backends)
-            else:
-                backend = available_backends[0]
-            
-            # 增加连接计数
-            if backend:
-                self.metrics[backend].active_connections += 1
+        select = self._strategy_dispatch.get(self.strategy)
+        backend = select(available_backends, request_hash) if select else available_backends[0]
+        
+        # 增加连接计数（后端可能刚被移除）
+        metrics = self.metrics.get(backend) if backend else None
+        if metrics is None:
+            return None
+        with metrics.lock:
+            metrics.active_connections += 1
+        
+        return backend
+    
+    @contextmanager
+    def acquire_backend(self, request_hash: Optional[str] = None) -> Iterator[Optional[str]]:
+        """
+        选择后端并占用一个连接，退出上下文时释放
+        
+        Args:
+            request_hash: 请求哈希，供一致性哈希策略使用
             
-            return backend
+        Yields:
+            Optional[str]: 选中的后端名称，没有可用后端时为None
+        """
+        backend_name = self.select_backend(request_hash)
+        try:
+            yield backend_name
+        finally:
+            if backend_name:
+                self.release_connection(backend_name)
     
     def _round_robin_select(self, available_backends: List[str]) -> str:
         """轮询策略"""
         if not available_backends:
             return None
         
-        backend = available_backends[self._round_robin_index % len(available_backends)]
-        self._round_robin_index = (self._round_robin_index + 1) % len(available_backends)
-        return backend
+        return available_backends[next(self._rr_counter) % len(available_backends)]
     
     def _weighted_round_robin_select(self, available_backends: List[str]) -> str:
         """加权轮询策略"""
         if not available_backends:
             return None
         
-        weighted_backends = []
-        for backend_name in available_backends:
-            weight = self.backends[backend_name].weight
-            weighted_backends.extend([backend_name] * weight)
+        # 加权展开只在可用后端列表变化后重建一次
+        cached = self._weighted_cache
+        if cached is not None and cached[0] is available_backends:
+            weighted_backends = cached[1]
+        else:
+            weighted_backends = []
+            for backend_name in available_backends:
+                weight = self.backends[backend_name].weight
+                weighted_backends.extend([backend_name] * weight)
+            self._weighted_cache = (available_backends, weighted_backends)
         
         if not weighted_backends:
             return available_backends[0]
         
-        backend = weighted_backends[self._round_robin_index % len(weighted_backends)]
-        self._round_robin_index = (self._round_robin_index + 1) % len(weighted_backends)
-        return backend
+        return weighted_backends[next(self._rr_counter) % len(weighted_backends)]
     
     def _least_connections_select(self, available_backends: List[str]) -> str:
         """最少连接数策略"""
         if not available_backends:
             return None
         
-        min_connections = float('inf')
-        selected_backend = available_backends[0]
-        
-        for backend_name in available_backends:
-            connections = self.metrics[backend_name].active_connections
-            if connections < min_connections:
-                min_connections = connections
-                selected_backend = backend_name
-        
-        return selected_backend
+        # 连接数相同时取列表中靠前的后端
+        metrics = self.metrics
+        return min(available_backends, key=lambda name: metrics[name].active_connections)
     
     def _random_select(self, available_backends: List[str]) -> str:
         """随机策略"""
@@ -277,28 +400,28 @@ class LLMLoadBalancer:
         return random.choice(available_backends)
     
     def _consistent_hash_select(self, request_hash: str) -> Optional[str]:
-        """一致性哈希策略"""
-        if not self._hash_ring:
+        """一致性哈希策略：从第一个大于等于请求哈希的节点开始，沿环找到第一个健康的后端"""
+        ring_size = len(self._ring_keys_sorted)
+        if not ring_size:
             return None
         
-        hash_value = int(hashlib.md5(request_hash.encode()).hexdigest(), 16)
-        
-        # 找到第一个大于等于hash_value的节点
-        for ring_hash in sorted(self._hash_ring.keys()):
-            if ring_hash >= hash_value:
-                backend_name = self._hash_ring[ring_hash]
-                if self.metrics[backend_name].status == BackendStatus.HEALTHY:
-                    return backend_name
-        
-        # 如果没有找到，选择第一个节点
-        if self._hash_ring:
-            first_hash = min(self._hash_ring.keys())
-            backend_name = self._hash_ring[first_hash]
+        start = bisect.bisect_left(self._ring_keys_sorted, self._ring_hash(request_hash))
+        for offset in range(ring_size):
+            backend_name = self._ring_backends_sorted[(start + offset) % ring_size]
             if self.metrics[backend_name].status == BackendStatus.HEALTHY:
                 return backend_name
         
         return None
     
+    def _consistent_hash_failover_select(self, available_backends: List[str],
+                                         request_hash: Optional[str]) -> Optional[str]:
+        """一致性哈希，失败时回退轮询"""
+        # 相同请求固定路由到同一后端以命中vLLM前缀缓存；没有请求哈希时不集中到单一后端
+        backend = self._consistent_hash_select(request_hash) if request_hash else None
+        if backend is None:
+            backend = self._round_robin_select(available_backends)
+        return backend
+    
     def _response_time_select(self, available_backends: List[str]) -> str:
         """响应时间最优策略"""
         if not available_backends:
@@ -317,19 +440,22 @@ class LLMLoadBalancer:
     
     def release_connection(self, backend_name: str):
         """释放连接"""
-        if backend_name in self.metrics:
-            with self._lock:
-                if self.metrics[backend_name].active_connections > 0:
-                    self.metrics[backend_name].active_connections -= 1
+        metrics = self.metrics.get(backend_name)
+        if metrics is None:
+            return
+        
+        with metrics.lock:
+            if metrics.active_connections > 0:
+                metrics.active_connections -= 1
     
     def record_request_result(self, backend_name: str, success: bool, 
                             response_time: float, error: Optional[str] = None):
         """记录请求结果"""
-        if backend_name not in self.metrics:
+        metrics = self.metrics.get(backend_name)
+        if metrics is None:
             return
         
-        with self._lock:
-            metrics = self.metrics[backend_name]
+        with metrics.lock:
             metrics.total_requests += 1
             
             if success:
@@ -346,8 +472,8 @@ class LLMLoadBalancer:
     def get_metrics(self) -> Dict[str, Dict[str, Any]]:
         """获取所有后端的指标"""
         result = {}
-        with self._lock:
-            for backend_name, metrics in self.metrics.items():
+        for backend_name, metrics in self.metrics.items():
+            with metrics.lock:
                 result[backend_name] = {
                     "status": metrics.status.value,
                     "total_requests": metrics.total_requests,
@@ -365,30 +491,39 @@ class LLMLoadBalancer:
     def add_backend(self, backend: BackendConfig):
         """动态添加后端"""
         with self._lock:
-            self.backends[backend.name] = backend
-            self.metrics[backend.name] = BackendMetrics()
-            self._build_hash_ring()
+            # 同名后端先移除其旧的虚拟节点（权重可能已变化）
+            self._remove_backend_from_ring(backend.name)
+            # 写时复制，无锁遍历的读者不会看到字典在迭代中改变
+            self.backends = {**self.backends, backend.name: backend}
+            self.metrics = {**self.metrics, backend.name: BackendMetrics()}
+            self._add_backend_to_ring(backend)
+            self._invalidate_available_cache()
         logger.info(f"添加后端: {backend.name}")
     
     def remove_backend(self, backend_name: str):
         """动态移除后端"""
         with self._lock:
             if backend_name in self.backends:
-                del self.backends[backend_name]
-                del self.metrics[backend_name]
-                self._build_hash_ring()
+                self._remove_backend_from_ring(backend_name)
+                self.backends = {k: v for k, v in self.backends.items() if k != backend_name}
+                self.metrics = {k: v for k, v in self.metrics.items() if k != backend_name}
+                self._invalidate_available_cache()
         logger.info(f"移除后端: {backend_name}")
     
     def enable_backend(self, backend_name: str):
         """启用后端"""
-        if backend_name in self.metrics:
-            with self._lock:
-                self.metrics[backend_name].status = BackendStatus.HEALTHY
+        metrics = self.metrics.get(backend_name)
+        if metrics is not None:
+            with metrics.lock:
+                metrics.status = BackendStatus.HEALTHY
+            self._invalidate_available_cache()
         logger.info(f"启用后端: {backend_name}")
     
     def disable_backend(self, backend_name: str):
         """禁用后端"""
-        if backend_name in self.metrics:
-            with self._lock:
-                self.metrics[backend_name].status = BackendStatus.DISABLED
+        metrics = self.metrics.get(backend_name)
+        if metrics is not None:
+            with metrics.lock:
+                metrics.status = BackendStatus.DISABLED
+            self._invalidate_available_cache()
         logger.info(f"禁用后端: {backend_name}") 
\ No newline at end of file
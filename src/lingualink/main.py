@@ -1,6 +1,8 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+import asyncio
 import uvicorn
 import sys
 import os
@@ -11,17 +13,44 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../.."))
 from config.settings import settings
 from src.lingualink.utils.logging_config import setup_logging
 from src.lingualink.api import audio_router, auth_router, health_router, cache_router
+from src.lingualink.api.audio_routes import llm_service
+from src.lingualink.auth.redis_cache import redis_cache
+from src.lingualink.auth.auth_service import auth_service
 
 # 设置日志
 setup_logging()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时连接Redis并订阅密钥失效通知，关闭时写回使用统计，释放Redis和LLM客户端连接池"""
+    await redis_cache.initialize()
+    invalidation_task = None
+    if redis_cache.enabled:
+        invalidation_task = asyncio.create_task(
+            redis_cache.listen_invalidations(auth_service.evict_local_cache)
+        )
+    
+    yield
+    
+    if invalidation_task is not None:
+        invalidation_task.cancel()
+        try:
+            await invalidation_task
+        except asyncio.CancelledError:
+            pass
+    await auth_service.close()
+    await redis_cache.close()
+    await llm_service.close()
+
 # 创建FastAPI应用
 app = FastAPI(
     title="Lingualink Server",
     description="音频转录和翻译服务 - 支持多语言翻译和API密钥鉴权",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # 添加CORS中间件
@@ -45,7 +74,8 @@ async def http_exception_handler(request, exc):
     """HTTP异常处理器"""
     return JSONResponse(
         status_code=exc.status_code,
-        content=exc.detail
+        content=exc.detail,
+        headers=exc.headers
     )
 
 @app.exception_handler(Exception)
@@ -3,7 +3,7 @@
 使用SQLite管理API密钥
 """
 
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Integer, Text
+from sqlalchemy import create_engine, event, Column, String, DateTime, Boolean, Integer, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -80,7 +80,15 @@ class DatabaseManager:
         
         # 创建数据库连接
         self.db_path = db_path
-        self.engine = create_engine(f'sqlite:///{db_path}', echo=False)
+        # 鉴权查询是高频读：连接池复用连接，允许在线程池中跨线程使用
+        self.engine = create_engine(
+            f'sqlite:///{db_path}',
+            echo=False,
+            connect_args={"check_same_thread": False},
+            pool_size=10,
+            max_overflow=20
+        )
+        event.listen(self.engine, "connect", self._set_sqlite_pragmas)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
         
         # 创建表
@@ -88,6 +96,17 @@ class DatabaseManager:
         
         logger.info(f"Database initialized at: {db_path}")
     
+    @staticmethod
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """新连接建立时设置SQLite参数：WAL模式下读写互不阻塞"""
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA cache_size=-64000")  # 约64MB页缓存
+        finally:
+            cursor.close()
+    
     def create_tables(self):
         """创建数据库表"""
         Base.metadata.create_all(bind=self.engine)
@@ -1,7 +1,8 @@
 from .logging_config import setup_logging
-from .key_generator import generate_initial_api_key
+from .key_generator import generate_initial_api_key, generate_api_keys
 
 __all__ = [
     "setup_logging",
-    "generate_initial_api_key"
+    "generate_initial_api_key",
+    "generate_api_keys"
 ] 
\ No newline at end of file
@@ -1,6 +1,7 @@
+import base64
 import secrets
 import sys
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime, timedelta
 
 
@@ -38,6 +39,25 @@ def generate_initial_api_key(name: Optional[str] = None, expires_in_days: Option
     return api_key
 
 
+def generate_api_keys(count: int) -> List[str]:
+    """
+    批量生成API密钥，格式与单个生成的密钥相同
+    
+    一次性读取所有随机字节再切片编码，批量开通时只需一次系统调用
+    
+    Args:
+        count: 生成的密钥数量
+        
+    Returns:
+        List[str]: 生成的API密钥列表
+    """
+    buf = secrets.token_bytes(32 * count)
+    return [
+        "lls_" + base64.urlsafe_b64encode(buf[i:i + 32]).rstrip(b"=").decode("ascii")
+        for i in range(0, len(buf), 32)
+    ]
+
+
 def main():
     """命令行工具入口"""
     import argparse
@@ -45,9 +65,21 @@ def main():
     parser = argparse.ArgumentParser(description="Generate API key for Lingualink Server")
     parser.add_argument("--name", "-n", help="Name for the API key", default=None)
     parser.add_argument("--expires-in-days", "-e", type=int, help="Expiration time in days", default=None)
+    parser.add_argument("--count", "-c", type=int, help="Number of keys to generate in bulk (prints keys only)", default=1)
     
     args = parser.parse_args()
     
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+    # 批量模式只逐行输出密钥，名称和过期时间无处体现，不能静默忽略
+    if args.count > 1 and (args.name is not None or args.expires_in_days is not None):
+        parser.error("--name and --expires-in-days cannot be combined with --count greater than 1")
+    
+    if args.count > 1:
+        for api_key in generate_api_keys(args.count):
+            print(api_key)
+        return
+    
     generate_initial_api_key(args.name, args.expires_in_days)
 
 
@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from src.lingualink.auth.auth_service import auth_service
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def async_client():
+    """整个测试会话共用的异步客户端，通过ASGI传输直接调用应用（首次使用时才导入应用，避免影响不需要应用的测试）"""
+    from httpx import ASGITransport, AsyncClient
+    from src.lingualink.main import app
+    
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def scratch(tmp_path_factory):
+    """整个测试会话共用的临时文件目录，优先放在内存文件系统（/dev/shm）上，会话结束时删除"""
+    shm = Path("/dev/shm")
+    if not (shm.is_dir() and os.access(shm, os.W_OK)):
+        yield tmp_path_factory.mktemp("scratch")
+        return
+    
+    path = Path(tempfile.mkdtemp(prefix="lingualink_test_", dir=shm))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def api_key():
+    """整个测试会话共用的API密钥（只用于不修改密钥状态的测试）"""
+    return auth_service.generate_api_key("test_key")
@@ -1,92 +1,207 @@
 import pytest
 import tempfile
 import os
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
 from src.lingualink.core.audio_converter import AudioConverter
 
 
+@pytest.fixture(scope="module")
+def converter():
+    """本模块共用的音频转换器（无状态依赖，无需每个测试重建）"""
+    return AudioConverter()
+
+
 class TestAudioConverter:
     """音频转换器测试类"""
     
-    def setup_method(self):
-        """测试方法设置"""
-        self.converter = AudioConverter()
-    
-    def test_get_audio_format(self):
+    def test_get_audio_format(self, converter):
         """测试音频格式识别"""
-        assert self.converter.get_audio_format("test.opus") == "opus"
-        assert self.converter.get_audio_format("test.wav") == "wav"
-        assert self.converter.get_audio_format("test.mp3") == "mp3"
-        assert self.converter.get_audio_format("test.unknown") == "unknown"
+        assert converter.get_audio_format("test.opus") == "opus"
+        assert converter.get_audio_format("test.wav") == "wav"
+        assert converter.get_audio_format("test.mp3") == "mp3"
+        assert converter.get_audio_format("test.unknown") == "unknown"
     
-    def test_is_format_supported(self):
+    def test_is_format_supported(self, converter):
         """测试格式支持检查"""
-        assert self.converter.is_format_supported("test.opus") is True
-        assert self.converter.is_format_supported("test.wav") is True
-        assert self.converter.is_format_supported("test.mp3") is True
-        assert self.converter.is_format_supported("test.unknown") is False
+        assert converter.is_format_supported("test.opus") is True
+        assert converter.is_format_supported("test.wav") is True
+        assert converter.is_format_supported("test.mp3") is True
+        assert converter.is_format_supported("test.unknown") is False
     
-    def test_needs_conversion(self):
+    def test_needs_conversion(self, converter, scratch):
         """测试转换需求检查"""
-        assert self.converter.needs_conversion("test.opus") is True
-        assert self.converter.needs_conversion("test.mp3") is True
-        assert self.converter.needs_conversion("test.wav") is False
+        import wave
+        
+        assert converter.needs_conversion("test.opus") is True
+        assert converter.needs_conversion("test.mp3") is True
+        # 不存在或无法解析文件头的WAV文件需要转换
+        assert converter.needs_conversion("test.wav") is True
+        
+        temp_wav_path = str(scratch / "needs_conversion.wav")
+        with wave.open(temp_wav_path, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(16000)
+            wav_file.writeframes(b'\x00\x00' * 160)
+        
+        assert converter.needs_conversion(temp_wav_path) is False
+    
+    @patch('src.lingualink.core.audio_converter.AudioSegment')
+    def test_is_wav_compatible_reads_header_only(self, mock_audio_segment, converter, scratch):
+        """测试兼容性检查只解析WAV文件头"""
+        import wave
+        
+        temp_wav_path = str(scratch / "header_only.wav")
+        for frame_rate, expected in ((16000, True), (48000, False)):
+            with wave.open(temp_wav_path, 'wb') as wav_file:
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(frame_rate)
+                wav_file.writeframes(b'\x00\x00' * 160)
+            
+            assert converter._is_wav_compatible(temp_wav_path) is expected
+        
+        mock_audio_segment.from_wav.assert_not_called()
     
     @patch('src.lingualink.core.audio_converter.AudioSegment')
-    def test_convert_to_wav_opus(self, mock_audio_segment):
+    def test_is_wav_compatible_rejects_non_riff(self, mock_audio_segment, converter, scratch):
+        """测试扩展名为.wav但没有RIFF/WAVE标识的文件直接判定为需要转换"""
+        temp_wav = scratch / "non_riff.wav"
+        temp_wav.write_bytes(b'OggS' + b'\x00' * 60)
+        temp_wav_path = str(temp_wav)
+        
+        assert converter._is_wav_compatible(temp_wav_path) is False
+        assert converter.needs_conversion(temp_wav_path) is True
+        mock_audio_segment.from_wav.assert_not_called()
+    
+    def test_needs_conversion_uses_head_bytes(self, converter):
+        """测试提供开头字节时直接从内存解析WAV文件头，不再打开文件"""
+        import io
+        import wave
+        
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(16000)
+            wav_file.writeframes(b'\x00\x00' * 160)
+        head = buffer.getvalue()[:64]
+        
+        # 文件并不存在，结果只能来自head
+        assert converter.needs_conversion("nonexistent.wav", head) is False
+        assert converter.needs_conversion("nonexistent.wav", b'OggS' + b'\x00' * 60) is True
+    
+    @patch('src.lingualink.core.audio_converter.subprocess.run')
+    def test_convert_to_wav_opus(self, mock_run, converter, scratch):
         """测试OPUS到WAV转换"""
-        # 模拟AudioSegment行为
-        mock_audio = Mock()
-        mock_audio.set_frame_rate.return_value = mock_audio
-        mock_audio.set_channels.return_value = mock_audio
-        mock_audio.set_sample_width.return_value = mock_audio
-        mock_audio_segment.from_file.return_value = mock_audio
+        # 模拟FFmpeg执行成功
+        mock_run.return_value = Mock(returncode=0, stderr=b'')
         
         # 创建临时OPUS文件
-        with tempfile.NamedTemporaryFile(suffix='.opus', delete=False) as temp_opus:
-            temp_opus.write(b'fake opus data')
-            temp_opus_path = temp_opus.name
+        temp_opus = scratch / "convert.opus"
+        temp_opus.write_bytes(b'fake opus data')
+        temp_opus_path = str(temp_opus)
         
+        wav_path = None
         try:
-            # 测试转换
-            with patch('os.path.exists', return_value=True):
-                wav_path = self.converter.convert_to_wav(temp_opus_path)
-                
-                # 验证调用
-                mock_audio_segment.from_file.assert_called_once_with(
-                    temp_opus_path, format="ogg", codec="libopus"
-                )
-                mock_audio.set_frame_rate.assert_called_once_with(16000)
-                mock_audio.set_channels.assert_called_once_with(1)
-                mock_audio.set_sample_width.assert_called_once_with(2)
-                mock_audio.export.assert_called_once()
-                
-                assert wav_path.endswith('.wav')
-                
+            # 测试转换（不模拟文件存在检查，转换成功路径上不应依赖它）
+            wav_path = converter.convert_to_wav(temp_opus_path)
+            
+            # 验证FFmpeg命令
+            mock_run.assert_called_once()
+            command = mock_run.call_args[0][0]
+            assert command[0] == "ffmpeg"
+            assert command[command.index("-i") + 1] == temp_opus_path
+            assert command[command.index("-ar") + 1] == "16000"
+            assert command[command.index("-ac") + 1] == "1"
+            assert command[command.index("-sample_fmt") + 1] == "s16"
+            assert command[-1] == wav_path
+            
+            assert wav_path.endswith('.wav')
+            
         finally:
-            # 清理
-            if os.path.exists(temp_opus_path):
-                os.remove(temp_opus_path)
+            # 清理转换输出（输出位于服务的临时目录，不在scratch中）
+            if wav_path and os.path.exists(wav_path):
+                os.remove(wav_path)
     
-    def test_convert_to_wav_file_not_exists(self):
+    @patch('src.lingualink.core.audio_converter.subprocess.run')
+    def test_convert_to_wav_ffmpeg_failure(self, mock_run, converter, scratch):
+        """测试FFmpeg转换失败"""
+        mock_run.return_value = Mock(returncode=1, stderr=b'Invalid data found')
+        
+        temp_opus = scratch / "ffmpeg_failure.opus"
+        temp_opus.write_bytes(b'fake opus data')
+        
+        with pytest.raises(IOError, match="Invalid data found"):
+            converter.convert_to_wav(str(temp_opus))
+
+    @patch('src.lingualink.core.audio_converter.subprocess.run')
+    def test_convert_to_wav_native_downmix(self, mock_run, converter, scratch):
+        """测试采样率已符合要求的立体声WAV在进程内转为单声道，不启动FFmpeg"""
+        import wave
+        
+        temp_wav_path = str(scratch / "native_downmix.wav")
+        wav_path = None
+        try:
+            with wave.open(temp_wav_path, 'wb') as wav_file:
+                wav_file.setnchannels(2)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(16000)
+                wav_file.writeframes(b'\x10\x00\x30\x00' * 160)
+            
+            with patch.object(converter, '_read_wav_header', wraps=converter._read_wav_header) as mock_header:
+                wav_path = converter.convert_to_wav(temp_wav_path)
+            
+            # 文件头在兼容性检查时解析一次，进程内转换直接复用
+            mock_header.assert_called_once()
+            mock_run.assert_not_called()
+            with wave.open(wav_path, 'rb') as wav_file:
+                assert wav_file.getparams()[:3] == (1, 2, 16000)
+                assert wav_file.readframes(2) == b'\x20\x00\x20\x00'
+        finally:
+            if wav_path and os.path.exists(wav_path):
+                os.remove(wav_path)
+
+    @patch('src.lingualink.core.audio_converter.asyncio.create_subprocess_exec')
+    async def test_convert_to_wav_async_subprocess(self, mock_exec, converter, scratch):
+        """测试异步转换直接以子进程运行FFmpeg"""
+        from src.lingualink.core.audio_converter import AsyncAudioConverter
+
+        mock_process = Mock(returncode=0)
+        mock_process.communicate = AsyncMock(return_value=(None, b''))
+        mock_exec.return_value = mock_process
+
+        temp_opus = scratch / "async_subprocess.opus"
+        temp_opus.write_bytes(b'fake opus data')
+        temp_opus_path = str(temp_opus)
+
+        wav_path = None
+        try:
+            wav_path = await AsyncAudioConverter(converter).convert_to_wav_async(temp_opus_path)
+
+            command = mock_exec.call_args[0]
+            assert command[0] == "ffmpeg"
+            assert command[command.index("-i") + 1] == temp_opus_path
+            assert command[-1] == wav_path
+        finally:
+            if wav_path and os.path.exists(wav_path):
+                os.remove(wav_path)
+
+    def test_convert_to_wav_file_not_exists(self, converter):
         """测试转换不存在的文件"""
         with pytest.raises(IOError, match="Input file does not exist"):
-            self.converter.convert_to_wav("nonexistent.opus")
+            converter.convert_to_wav("nonexistent.opus")
     
-    def test_convert_to_wav_unsupported_format(self):
+    def test_convert_to_wav_unsupported_format(self, converter, scratch):
         """测试转换不支持的格式"""
-        with tempfile.NamedTemporaryFile(suffix='.unknown', delete=False) as temp_file:
-            temp_file.write(b'fake data')
-            temp_file_path = temp_file.name
+        temp_file = scratch / "unsupported.unknown"
+        temp_file.write_bytes(b'fake data')
         
-        try:
-            with pytest.raises(ValueError, match="Unsupported audio format"):
-                self.converter.convert_to_wav(temp_file_path)
-        finally:
-            os.remove(temp_file_path)
+        with pytest.raises(ValueError, match="Unsupported audio format"):
+            converter.convert_to_wav(str(temp_file))
     
     @patch('src.lingualink.core.audio_converter.AudioSegment')
-    def test_get_audio_info_opus(self, mock_audio_segment):
+    def test_get_audio_info_opus(self, mock_audio_segment, converter, scratch):
         """测试获取OPUS音频信息"""
         # 模拟AudioSegment行为
         mock_audio = Mock()
@@ -96,84 +211,89 @@ class TestAudioConverter:
         mock_audio.sample_width = 2
         mock_audio_segment.from_file.return_value = mock_audio
         
-        with tempfile.NamedTemporaryFile(suffix='.opus', delete=False) as temp_opus:
-            temp_opus.write(b'fake opus data')
-            temp_opus_path = temp_opus.name
+        temp_opus = scratch / "info.opus"
+        temp_opus.write_bytes(b'fake opus data')
         
-        try:
-            info = self.converter.get_audio_info(temp_opus_path)
-            
-            assert info['exists'] is True
-            assert info['format'] == 'opus'
-            assert info['duration_seconds'] == 5.0
-            assert info['frame_rate'] == 48000
-            assert info['channels'] == 2
-            assert info['sample_width'] == 2
-            assert info['needs_conversion'] is True
-            
-        finally:
-            os.remove(temp_opus_path)
+        info = converter.get_audio_info(str(temp_opus))
+        
+        assert info['exists'] is True
+        assert info['format'] == 'opus'
+        assert info['duration_seconds'] == 5.0
+        assert info['frame_rate'] == 48000
+        assert info['channels'] == 2
+        assert info['sample_width'] == 2
+        assert info['needs_conversion'] is True
+    
+    @patch('src.lingualink.core.audio_converter.AudioSegment')
+    def test_get_audio_info_opus_header_only(self, mock_audio_segment, converter, scratch):
+        """测试OPUS信息从OpusHead和最后一个Ogg页的颗粒位置解析，不解码文件"""
+        import struct
+        
+        def ogg_page(granule, payload):
+            return (b'OggS' + bytes([0, 0]) + struct.pack('<qIII', granule, 1, 0, 0)
+                    + bytes([1, len(payload)]) + payload)
+        
+        opus_head = b'OpusHead' + bytes([1, 2]) + struct.pack('<HIhB', 312, 48000, 0, 0)
+        temp_opus = scratch / "info_header_only.opus"
+        temp_opus.write_bytes(ogg_page(0, opus_head) + ogg_page(-1, b'\x00' * 10) + ogg_page(240312, b'\x00' * 10))
+        
+        info = converter.get_audio_info(str(temp_opus))
+        
+        assert info["duration_seconds"] == 5.0
+        assert info["frame_rate"] == 48000
+        assert info["channels"] == 2
+        mock_audio_segment.from_file.assert_not_called()
     
-    def test_get_audio_info_nonexistent(self):
+    def test_get_audio_info_nonexistent(self, converter):
         """测试获取不存在文件的信息"""
-        info = self.converter.get_audio_info("nonexistent.opus")
+        info = converter.get_audio_info("nonexistent.opus")
         assert info['exists'] is False
     
-    def test_cleanup_converted_file(self):
+    def test_cleanup_converted_file(self, converter, scratch):
         """测试清理转换后的文件"""
         # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False) as temp_converted:
-            temp_converted.write(b'converted data')
-            converted_path = temp_converted.name
-        
-        with tempfile.NamedTemporaryFile(delete=False) as temp_original:
-            temp_original.write(b'original data')
-            original_path = temp_original.name
+        converted = scratch / "cleanup_converted.wav"
+        converted.write_bytes(b'converted data')
+        original = scratch / "cleanup_original.opus"
+        original.write_bytes(b'original data')
         
-        try:
-            # 测试清理转换后的文件
-            result = self.converter.cleanup_converted_file(converted_path, original_path)
-            assert result is True
-            assert not os.path.exists(converted_path)
-            assert os.path.exists(original_path)  # 原始文件不应被删除
-            
-        finally:
-            # 清理剩余文件
-            if os.path.exists(original_path):
-                os.remove(original_path)
+        # 测试清理转换后的文件
+        result = converter.cleanup_converted_file(str(converted), str(original))
+        assert result is True
+        assert not converted.exists()
+        assert original.exists()  # 原始文件不应被删除
     
-    def test_cleanup_converted_file_same_as_original(self):
+    def test_cleanup_converted_file_same_as_original(self, converter, scratch):
         """测试清理转换后的文件（与原始文件相同）"""
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(b'same file')
-            file_path = temp_file.name
+        same_file = scratch / "cleanup_same.wav"
+        same_file.write_bytes(b'same file')
         
-        try:
-            # 文件路径相同时不应删除
-            result = self.converter.cleanup_converted_file(file_path, file_path)
-            assert result is True
-            assert os.path.exists(file_path)  # 文件应该存在
-            
-        finally:
-            os.remove(file_path)
+        # 文件路径相同时不应删除
+        result = converter.cleanup_converted_file(str(same_file), str(same_file))
+        assert result is True
+        assert same_file.exists()  # 文件应该存在
 
 
 @pytest.mark.asyncio
 class TestAudioProcessorIntegration:
     """音频处理器集成测试"""
     
+    @patch('src.lingualink.core.audio_processor.AsyncAudioConverter')
     @patch('src.lingualink.core.audio_processor.AudioConverter')
-    async def test_process_and_convert_audio_opus(self, mock_converter_class):
+    async def test_process_and_convert_audio_opus(self, mock_converter_class, mock_async_converter_class):
         """测试处理OPUS音频文件"""
-        from src.lingualink.core.audio_processor import AudioProcessor
+        from src.lingualink.core.audio_processor import AudioProcessor, SavedUpload
         from fastapi import UploadFile
         from io import BytesIO
         
         # 模拟转换器
         mock_converter = Mock()
         mock_converter.needs_conversion.return_value = True
-        mock_converter.convert_to_wav.return_value = "/tmp/converted.wav"
+        mock_converter.get_conversion_stats.return_value = {"active_conversions": 0, "total_conversions": 1}
         mock_converter_class.return_value = mock_converter
+        mock_async_converter = Mock()
+        mock_async_converter.convert_to_wav_async = AsyncMock(return_value="/tmp/converted.wav")
+        mock_async_converter_class.return_value = mock_async_converter
         
         processor = AudioProcessor()
         
@@ -187,20 +307,21 @@ class TestAudioProcessorIntegration:
         # 模拟保存上传文件和文件存在检查
         with patch.object(processor, 'save_upload_file') as mock_save, \
              patch('os.path.exists', return_value=True):
-            mock_save.return_value = "/tmp/original.opus"
+            mock_save.return_value = SavedUpload(path="/tmp/original.opus", size=len(file_content), head=file_content)
             
             # 测试处理
             wav_path, original_path = await processor.process_and_convert_audio(upload_file)
             
             assert wav_path == "/tmp/converted.wav"
             assert original_path == "/tmp/original.opus"
-            mock_converter.needs_conversion.assert_called_once_with("/tmp/original.opus")
-            mock_converter.convert_to_wav.assert_called_once_with("/tmp/original.opus")
+            mock_converter.needs_conversion.assert_called_once_with("/tmp/original.opus", file_content)
+            mock_async_converter_class.assert_called_once_with(mock_converter)
+            mock_async_converter.convert_to_wav_async.assert_awaited_once_with("/tmp/original.opus")
     
     @patch('src.lingualink.core.audio_processor.AudioConverter')
     async def test_process_and_convert_audio_wav(self, mock_converter_class):
         """测试处理WAV音频文件（无需转换）"""
-        from src.lingualink.core.audio_processor import AudioProcessor
+        from src.lingualink.core.audio_processor import AudioProcessor, SavedUpload
         from fastapi import UploadFile
         from io import BytesIO
         
@@ -220,12 +341,37 @@ class TestAudioProcessorIntegration:
         
         # 模拟保存上传文件
         with patch.object(processor, 'save_upload_file') as mock_save:
-            mock_save.return_value = "/tmp/original.wav"
+            mock_save.return_value = SavedUpload(path="/tmp/original.wav", size=len(file_content), head=file_content)
             
             # 测试处理
             wav_path, original_path = await processor.process_and_convert_audio(upload_file)
             
             assert wav_path == "/tmp/original.wav"
             assert original_path == "/tmp/original.wav"
-            mock_converter.needs_conversion.assert_called_once_with("/tmp/original.wav")
-            mock_converter.convert_to_wav.assert_not_called() 
\ No newline at end of file
+            mock_converter.needs_conversion.assert_called_once_with("/tmp/original.wav", file_content)
+            mock_converter.convert_to_wav.assert_not_called()
+    
+    async def test_save_upload_file_rolled_to_disk_uses_sendfile(self):
+        """测试已落盘的上传文件通过sendfile复制到临时目录"""
+        from src.lingualink.core.audio_processor import AudioProcessor
+        from fastapi import UploadFile
+        
+        processor = AudioProcessor()
+        file_content = b'OggS' + os.urandom(4096)
+        spooled = tempfile.SpooledTemporaryFile(max_size=16)
+        spooled.write(file_content)
+        spooled.seek(0)
+        upload_file = UploadFile(filename="test.opus", file=spooled)
+        
+        with patch('os.sendfile', wraps=os.sendfile) as mock_sendfile:
+            saved = await processor.save_upload_file(upload_file)
+        
+        try:
+            mock_sendfile.assert_called()
+            assert saved.size == len(file_content)
+            assert saved.head == file_content[:processor.UPLOAD_HEAD_SIZE]
+            with open(saved.path, 'rb') as f:
+                assert f.read() == file_content
+        finally:
+            os.remove(saved.path)
+            spooled.close()
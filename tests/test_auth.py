@@ -1,67 +1,57 @@
+import asyncio
 import pytest
-from fastapi.testclient import TestClient
-import sys
-import os
+from unittest.mock import patch
 
-# 添加项目根目录到Python路径
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-
-from src.lingualink.main import app
 from src.lingualink.auth.auth_service import auth_service
-
-client = TestClient(app)
+from src.lingualink.auth.local_cache import LocalTTLCache
+from src.lingualink.auth.redis_cache import redis_cache
 
 
 class TestAuth:
     """鉴权功能测试"""
     
-    def setup_method(self):
-        """测试前设置"""
-        # 生成测试用的API密钥
-        self.test_api_key = auth_service.generate_api_key("test_key")
-    
-    def test_health_check_no_auth(self):
+    async def test_health_check_no_auth(self, async_client):
         """测试健康检查不需要鉴权"""
-        response = client.get("/api/v1/health")
+        response = await async_client.get("/api/v1/health")
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "healthy"
     
-    def test_ping_no_auth(self):
+    async def test_ping_no_auth(self, async_client):
         """测试ping不需要鉴权"""
-        response = client.get("/api/v1/ping")
+        response = await async_client.get("/api/v1/ping")
         assert response.status_code == 200
         data = response.json()
         assert data["message"] == "pong"
     
-    def test_verify_api_key_valid(self):
+    async def test_verify_api_key_valid(self, async_client, api_key):
         """测试验证有效的API密钥"""
-        headers = {"X-API-Key": self.test_api_key}
-        response = client.get("/api/v1/auth/verify", headers=headers)
+        headers = {"X-API-Key": api_key}
+        response = await async_client.get("/api/v1/auth/verify", headers=headers)
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "success"
         assert data["message"] == "API key is valid"
     
-    def test_verify_api_key_invalid(self):
+    async def test_verify_api_key_invalid(self, async_client):
         """测试验证无效的API密钥"""
         headers = {"X-API-Key": "invalid_key"}
-        response = client.get("/api/v1/auth/verify", headers=headers)
+        response = await async_client.get("/api/v1/auth/verify", headers=headers)
         assert response.status_code == 401
         data = response.json()
         assert data["status"] == "error"
     
-    def test_verify_api_key_missing(self):
+    async def test_verify_api_key_missing(self, async_client):
         """测试缺少API密钥"""
-        response = client.get("/api/v1/auth/verify")
+        response = await async_client.get("/api/v1/auth/verify")
         assert response.status_code == 401
         data = response.json()
         assert data["status"] == "error"
     
-    def test_generate_new_api_key(self):
+    async def test_generate_new_api_key(self, async_client, api_key):
         """测试生成新的API密钥"""
-        headers = {"X-API-Key": self.test_api_key}
-        response = client.post(
+        headers = {"X-API-Key": api_key}
+        response = await async_client.post(
             "/api/v1/auth/generate_key",
             headers=headers,
             params={"name": "new_test_key"}
@@ -72,20 +62,206 @@ class TestAuth:
         assert "api_key" in data["data"]
         assert data["data"]["name"] == "new_test_key"
     
-    def test_list_api_keys(self):
+    async def test_list_api_keys(self, async_client, api_key):
         """测试列出API密钥"""
-        headers = {"X-API-Key": self.test_api_key}
-        response = client.get("/api/v1/auth/keys", headers=headers)
+        headers = {"X-API-Key": api_key}
+        response = await async_client.get("/api/v1/auth/keys", headers=headers)
         assert response.status_code == 200
         data = response.json()
         assert data["status"] == "success"
         assert "keys" in data["data"]
         assert "total" in data["data"]
     
-    def test_bearer_token_auth(self):
+    async def test_bearer_token_auth(self, async_client, api_key):
         """测试Bearer token认证"""
-        headers = {"Authorization": f"Bearer {self.test_api_key}"}
-        response = client.get("/api/v1/auth/verify", headers=headers)
+        headers = {"Authorization": f"Bearer {api_key}"}
+        response = await async_client.get("/api/v1/auth/verify", headers=headers)
         assert response.status_code == 200
         data = response.json()
-        assert data["status"] == "success" 
\ No newline at end of file
+        assert data["status"] == "success" 
+    
+    def test_usage_stats_batched_flush(self):
+        """测试缓存命中的使用统计批量写回"""
+        api_key = auth_service.generate_api_key("usage_test_key")
+        for _ in range(3):
+            auth_service._async_update_usage_stats(api_key)
+        auth_service.flush_usage_stats()
+        
+        key_info = auth_service.get_key_info(api_key)
+        assert key_info["usage_count"] == 3
+    
+    async def test_usage_flush_runs_off_event_loop(self):
+        """测试事件循环中触发的使用统计写回在线程中执行"""
+        import threading
+        
+        api_key = auth_service.generate_api_key("usage_thread_test_key")
+        flush_threads = []
+        with patch.object(auth_service, 'flush_usage_stats',
+                          side_effect=lambda: flush_threads.append(threading.current_thread())):
+            auth_service._last_usage_flush = 0.0
+            auth_service._async_update_usage_stats(api_key)
+            await asyncio.gather(*auth_service._flush_tasks)
+        
+        assert flush_threads and flush_threads[0] is not threading.current_thread()
+        await auth_service.close()
+    
+    async def test_usage_stats_flushed_on_close(self):
+        """测试关闭时写回尚未达到批量阈值的使用统计"""
+        api_key = auth_service.generate_api_key("usage_close_test_key")
+        await auth_service.close()
+        for _ in range(2):
+            auth_service._async_update_usage_stats(api_key)
+        await auth_service.close()
+        
+        assert auth_service.get_key_info(api_key)["usage_count"] == 2
+    
+    async def test_set_admin_status_evicts_local_cache(self):
+        """测试修改管理员状态后进程内缓存失效"""
+        api_key = auth_service.generate_api_key("admin_status_test_key")
+        key_hash = redis_cache.hash_api_key(api_key)
+        auth_service._local_cache.set(key_hash, False)
+        
+        assert await auth_service.set_admin_status(api_key, True)
+        assert auth_service._local_cache.get(key_hash) is None
+    
+    async def test_set_admin_status_invalidates_redis_cache(self):
+        """测试取消管理员后Redis中缓存的管理员标记不会再被读回"""
+        api_key = auth_service.generate_api_key("admin_demote_test_key", is_admin=True)
+        store = {}
+        
+        async def fake_get(key):
+            return store.get(key)
+        
+        async def fake_set(key, is_valid, is_admin, release_lock=False, expires_at=None):
+            store[key] = (is_valid, is_admin)
+            return True
+        
+        async def fake_invalidate(key):
+            return store.pop(key, None) is not None
+        
+        with patch.object(redis_cache, 'get_api_key_auth', side_effect=fake_get), \
+             patch.object(redis_cache, 'set_api_key_auth', side_effect=fake_set), \
+             patch.object(redis_cache, 'invalidate_api_key', side_effect=fake_invalidate):
+            assert await auth_service.verify_api_key(api_key) == (True, True)
+            assert store[api_key] == (True, True)
+            
+            assert await auth_service.set_admin_status(api_key, False)
+            assert await auth_service.verify_api_key(api_key) == (True, False)
+    
+    async def test_cleanup_expired_keys_invalidates_cache(self):
+        """测试清理过期密钥时清除其Redis缓存和进程内缓存"""
+        from datetime import datetime, timedelta
+        from src.lingualink.models.database import APIKey, get_db_session
+        
+        api_key = auth_service.generate_api_key("expired_cleanup_test_key", expires_in_days=1)
+        key_hash = redis_cache.hash_api_key(api_key)
+        session = get_db_session()
+        try:
+            session.query(APIKey).filter(APIKey.api_key == api_key).update(
+                {APIKey.expires_at: datetime.utcnow() - timedelta(days=1)}
+            )
+            session.commit()
+        finally:
+            session.close()
+        auth_service._local_cache.set(key_hash, False)
+        
+        with patch.object(redis_cache, 'invalidate_api_key') as mock_invalidate:
+            assert await auth_service.cleanup_expired_keys() >= 1
+        
+        mock_invalidate.assert_any_await(api_key)
+        assert auth_service._local_cache.get(key_hash) is None
+    
+    async def test_invalid_key_negative_cached(self):
+        """测试无效密钥在进程内负缓存，重复请求不再查询数据库"""
+        invalid_key = "lls_negative_cache_test"
+        try:
+            with patch.object(auth_service, '_verify_api_key_from_db', return_value=(False, False, None)) as mock_db:
+                for _ in range(2):
+                    assert await auth_service.verify_api_key(invalid_key) == (False, False)
+            
+            mock_db.assert_called_once()
+        finally:
+            auth_service.evict_local_cache(redis_cache.hash_api_key(invalid_key))
+
+    
+    async def test_auth_failure_limit_only_throttles_invalid_keys(self):
+        """测试IP鉴权失败超限后，该IP上未缓存的有效密钥仍可通过，无效密钥被限流"""
+        from src.lingualink.auth.auth_service import AuthRateLimitedError
+        
+        api_key = auth_service.generate_api_key("throttle_valid_test_key")
+        invalid_key = "lls_throttle_invalid_test"
+        try:
+            with patch.object(redis_cache, 'record_auth_failure', return_value=1000):
+                assert await auth_service.verify_api_key(api_key, "203.0.113.7") == (True, False)
+                with pytest.raises(AuthRateLimitedError):
+                    await auth_service.verify_api_key(invalid_key, "203.0.113.7")
+        finally:
+            auth_service.evict_local_cache(redis_cache.hash_api_key(api_key))
+            auth_service.evict_local_cache(redis_cache.hash_api_key(invalid_key))
+    
+    async def test_auth_failure_limit_returns_429(self, async_client):
+        """测试鉴权失败超限时返回429和Retry-After"""
+        invalid_key = "lls_throttle_http_test"
+        try:
+            with patch.object(redis_cache, 'record_auth_failure', return_value=1000):
+                response = await async_client.get("/api/v1/auth/verify", headers={"X-API-Key": invalid_key})
+            assert response.status_code == 429
+            assert response.headers["Retry-After"] == str(redis_cache.AUTH_FAILURE_WINDOW)
+        finally:
+            auth_service.evict_local_cache(redis_cache.hash_api_key(invalid_key))
+    
+    def test_client_ip_from_trusted_proxy(self):
+        """测试只信任来自受信任代理的X-Forwarded-For"""
+        import ipaddress
+        from starlette.requests import Request
+        from src.lingualink.auth import dependencies
+        
+        def make_request(peer, forwarded_for):
+            return Request({
+                "type": "http",
+                "client": (peer, 12345),
+                "headers": [(b"x-forwarded-for", forwarded_for.encode())],
+            })
+        
+        with patch.object(dependencies, '_TRUSTED_PROXIES', (ipaddress.ip_network("10.0.0.0/8"),)):
+            # 客户端伪造的最左侧地址被忽略，取代理追加的最右侧非代理地址
+            assert dependencies._client_ip(make_request("10.0.0.2", "1.1.1.1, 198.51.100.9, 10.0.0.5")) == "198.51.100.9"
+            # 非受信任来源的X-Forwarded-For不被采用
+            assert dependencies._client_ip(make_request("198.51.100.20", "1.1.1.1")) == "198.51.100.20"
+
+    async def test_redis_cache_entry_past_key_expiry_is_miss(self):
+        """测试Redis缓存条目不会在密钥过期后继续通过验证"""
+        import time
+        from unittest.mock import AsyncMock, PropertyMock
+
+        now = int(time.time())
+        with patch.object(type(redis_cache), 'available', new_callable=PropertyMock, return_value=True), \
+             patch.object(redis_cache, '_get_and_touch', new=AsyncMock(), create=True) as mock_touch:
+            mock_touch.return_value = f"1:{now}:{now + 60}"
+            assert await redis_cache.get_api_key_auth("lls_expiry_test") == (True, True)
+            mock_touch.return_value = f"1:{now - 10}:{now - 1}"
+            assert await redis_cache.get_api_key_auth("lls_expiry_test") is None
+            # 旧格式条目按未命中处理
+            mock_touch.return_value = f"1:{now}"
+            assert await redis_cache.get_api_key_auth("lls_expiry_test") is None
+
+class TestLocalTTLCache:
+    """进程内缓存测试"""
+    
+    def test_lru_eviction(self):
+        """测试超出容量时淘汰最久未使用的条目"""
+        cache = LocalTTLCache(maxsize=2, ttl=60)
+        cache.set("a", True)
+        cache.set("b", False)
+        assert cache.get("a") is True
+        cache.set("c", True)
+        
+        assert cache.get("b") is None
+        assert cache.get("a") is True
+        assert cache.get("c") is True
+    
+    def test_ttl_expiry(self):
+        """测试条目过期"""
+        cache = LocalTTLCache(maxsize=2, ttl=0)
+        cache.set("a", True)
+        assert cache.get("a") is None